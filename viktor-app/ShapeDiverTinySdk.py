@@ -1,5 +1,8 @@
+import asyncio
 import json
-import requests
+
+import httpx
+from viktor_subdomain import http_transport
 
 fileEndingToContentTypeMap = {
     "svg": "image/svg+xml",
@@ -244,7 +247,7 @@ class ShapeDiverTinySessionSdk:
             headers = {
                 'Content-Type': 'application/json'
             }
-            response = requests.post(endpoint, data=jsonBody, headers=headers)
+            response = http_transport.post(endpoint, data=jsonBody, headers=headers)
             if response.status_code != 201:
                 raise Exception(f'Failed to open session (HTTP status code {response.status_code}): {response.text}')
 
@@ -263,7 +266,7 @@ class ShapeDiverTinySessionSdk:
         """
 
         endpoint = f'{self.modelViewUrl}/api/v2/session/{self.response.sessionId()}/close'
-        response = requests.post(endpoint);
+        response = http_transport.post(endpoint);
         if response.status_code != 200:
             raise Exception(f'Failed to close session (HTTP status code {response.status_code}): {response.text}')
 
@@ -280,7 +283,7 @@ class ShapeDiverTinySessionSdk:
         headers = {
             'Content-Type': 'application/json'
         }
-        response = requests.put(endpoint, data=jsonBody, headers=headers)
+        response = http_transport.put(endpoint, data=jsonBody, headers=headers)
         if response.status_code != 200:
             raise Exception(f'Failed to compute outputs (HTTP status code {response.status_code}): {response.text}')
 
@@ -302,7 +305,7 @@ class ShapeDiverTinySessionSdk:
         headers = {
             'Content-Type': 'application/json'
         }
-        response = requests.put(endpoint, data=jsonBody, headers=headers)
+        response = http_transport.put(endpoint, data=jsonBody, headers=headers)
         if response.status_code != 200:
             raise Exception(f'Failed to compute export (HTTP status code {response.status_code}): {response.text}')
 
@@ -322,10 +325,114 @@ class ShapeDiverTinySessionSdk:
         headers = {
             'Content-Type': 'application/json'
         }
-        response = requests.post(endpoint, data=jsonBody, headers=headers)
+        response = http_transport.post(endpoint, data=jsonBody, headers=headers)
         if response.status_code != 200:
             raise Exception(f'Failed to request file upload (HTTP status code {response.status_code}): {response.text}')
 
         # TODO: handle rate-limiting and delay
 
         return ShapeDiverResponse(response.json())
+
+
+class AsyncShapeDiverTinySessionSdk:
+    """Asynchronous variant of ShapeDiverTinySessionSdk that reuses one session for many output requests.
+
+    All requests go through one pooled keep-alive connection, at most maxConcurrency output requests are in flight at
+    the same time. Use it as async context manager to close the session deterministically:
+
+        async with AsyncShapeDiverTinySessionSdk(modelViewUrl=url, ticket=ticket) as sdk:
+            responses = await sdk.outputs(paramDicts=[{...}, {...}])
+    """
+
+    def __init__(self, *, modelViewUrl, ticket, paramDict={}, maxConcurrency=8, timeout=60, parameterMapper=None,
+                 transport=None):
+        """Prepare a session with a ShapeDiver model, the session is opened by open() or when entering the context
+
+        A custom httpx transport can be given, e.g. httpx.MockTransport to test without a ShapeDiver backend.
+        """
+
+        self.modelViewUrl = modelViewUrl
+        self.ticket = ticket
+        self.paramDict = paramDict
+        self.response = None
+
+        if parameterMapper is not None:
+            self.parameterMapper = parameterMapper
+
+        limits = httpx.Limits(max_connections=maxConcurrency, max_keepalive_connections=maxConcurrency)
+        self._client = httpx.AsyncClient(timeout=timeout, limits=limits, transport=transport)
+        self._semaphore = asyncio.Semaphore(maxConcurrency)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def open(self):
+        """Open the session
+
+        API documentation: https://sdr7euc1.eu-central-1.shapediver.com/api/v2/docs/#/session/post_api_v2_ticket__ticketId_
+        """
+
+        endpoint = f'{self.modelViewUrl}/api/v2/ticket/{self.ticket}'
+        jsonBody = self.paramDict if isinstance(self.paramDict, str) else json.dumps(self.paramDict)
+        headers = {
+            'Content-Type': 'application/json'
+        }
+        response = await self._client.post(endpoint, content=jsonBody, headers=headers)
+        if response.status_code != 201:
+            raise Exception(f'Failed to open session (HTTP status code {response.status_code}): {response.text}')
+
+        """Parsed response of the session init request"""
+        self.response = ShapeDiverResponse(response.json())
+        return self
+
+    async def close(self):
+        """Close the session, if it was opened, and the connection pool
+
+        API documentation: https://sdr7euc1.eu-central-1.shapediver.com/api/v2/docs/#/session/post_api_v2_session__sessionId__close
+        """
+
+        try:
+            if self.response is not None:
+                endpoint = f'{self.modelViewUrl}/api/v2/session/{self.response.sessionId()}/close'
+                response = await self._client.post(endpoint)
+                self.response = None
+                if response.status_code != 200:
+                    raise Exception(f'Failed to close session (HTTP status code {response.status_code}): {response.text}')
+        finally:
+            await self._client.aclose()
+
+    @ParameterMapper
+    async def output(self, *, paramDict = {}):
+        """Request the computation of all outputs
+
+        API documentation: https://sdr7euc1.eu-central-1.shapediver.com/api/v2/docs/#/output/put_api_v2_session__sessionId__output
+        """
+
+        endpoint = f'{self.modelViewUrl}/api/v2/session/{self.response.sessionId()}/output'
+        jsonBody = json.dumps(paramDict)
+        headers = {
+            'Content-Type': 'application/json'
+        }
+        async with self._semaphore:
+            response = await self._client.put(endpoint, content=jsonBody, headers=headers)
+        if response.status_code != 200:
+            raise Exception(f'Failed to compute outputs (HTTP status code {response.status_code}): {response.text}')
+
+        return ShapeDiverResponse(response.json())
+
+    async def outputs(self, *, paramDicts):
+        """Request the computation of all outputs for several sets of parameters, results are in the same order"""
+
+        return await asyncio.gather(*[self.output(paramDict=paramDict) for paramDict in paramDicts])
+
+    async def download(self, href):
+        """Download content, e.g. the href of a content item, over the pooled connection"""
+
+        async with self._semaphore:
+            response = await self._client.get(href)
+        response.raise_for_status()
+        return response.content
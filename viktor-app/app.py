@@ -2,7 +2,6 @@ import datetime
 from io import BytesIO
 from pathlib import Path
 
-import requests
 from viktor import ViktorController, UserError, progress_message
 from viktor.external.word import render_word_file, WordFileImage, WordFileTag
 from viktor.parametrization import ViktorParametrization, ActionButton, DateField, TextField, Page, Text, \
@@ -12,7 +11,7 @@ from viktor.utils import convert_word_to_pdf
 from viktor.views import GeometryView, GeometryResult, PDFView, PDFResult, ImageView, \
     ImageResult
 from raytrace import gltf_raytrace
-from forma_storage import get_surroundings, get_terrain
+from forma_storage import get_surroundings, get_terrain, get_two_legged_aps_token
 from viktor_subdomain.helper_functions import set_environment_variables
 from generation import generate
 
@@ -105,15 +104,7 @@ class Controller(ViktorController):
 
     @staticmethod
     def get_two_legged_aps_token(base64_auth: str) -> str:
-        two_legged_res = requests.post("https://developer.api.autodesk.com/authentication/v2/token",
-                                    data={'grant_type': 'client_credentials', 'scope': "data:write"},
-                                    headers={
-                                        'Content-Type': 'application/x-www-form-urlencoded',
-                                        'Accept': "application/json",
-                                        'Authorization': f"Basic {base64_auth}"})
-        two_legged_res.raise_for_status()
-        access_token = two_legged_res.json()["access_token"]
-        return access_token
+        return get_two_legged_aps_token(base64_auth)
 
     @staticmethod
     def _get_gltf(params):
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from pathlib import Path
+
+CACHE_ROOT = Path(os.getenv("VIKTOR_APP_CACHE_DIR", Path(tempfile.gettempdir()) / "aectech-gen-collab"))
+
+
+def hash_key(*parts) -> str:
+    """Stable cache key of json-serializable parts, e.g. a content hash and the parameters that were used"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+class DiskCache:
+    """Directory based cache of which each entry is a folder with one or more files.
+
+    Entries are written to a temporary folder first and then renamed into place, so several threads or worker processes
+    can share the same cache: readers never see a half-written entry, and when two writers race the first one wins.
+    When the total size exceeds max_bytes, the least recently used entries are removed.
+    """
+
+    def __init__(self, name: str, max_bytes: int, root: Path = None):
+        self.directory = Path(root or CACHE_ROOT) / name
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def entry_path(self, key: str) -> Path:
+        return self.directory / key
+
+    def lookup(self, key: str):
+        """Returns the folder of the entry, or None if it is not cached"""
+        path = self.entry_path(key)
+        if path.is_dir():
+            try:
+                os.utime(path)  # mark as recently used
+            except FileNotFoundError:  # evicted by another process in the meantime
+                path = None
+        else:
+            path = None
+        with self._lock:
+            if path is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return path
+
+    def store(self, key: str, write, replace: bool = False) -> Path:
+        """Creates the entry by calling write(folder) and returns the folder of the entry.
+
+        An existing entry is kept, unless replace is set, e.g. when the cached content is outdated.
+        """
+        path = self.entry_path(key)
+        temporary_path = self.directory / f".tmp-{uuid.uuid4().hex}"
+        temporary_path.mkdir()
+        try:
+            write(temporary_path)
+            if replace:
+                self._discard(path)
+            os.replace(temporary_path, path)
+        except OSError:
+            if not path.is_dir():
+                raise
+            # another writer stored the same entry first
+        finally:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+        self.evict()
+        return path
+
+    def _discard(self, path: Path) -> bool:
+        """Removes the entry, renaming it first so no reader ends up with a partially removed entry"""
+        trash = self.directory / f".tmp-{uuid.uuid4().hex}"
+        try:
+            os.replace(path, trash)
+        except OSError:  # not cached, or removed by another process in the meantime
+            return False
+        shutil.rmtree(trash, ignore_errors=True)
+        return True
+
+    def evict(self) -> None:
+        """Removes the least recently used entries until the cache fits within max_bytes"""
+        entries = []
+        for path in self.directory.iterdir():
+            if path.name.startswith(".tmp-"):
+                continue
+            try:
+                size = sum(file.stat().st_size for file in path.iterdir())
+                entries.append((path.stat().st_mtime, size, path))
+            except FileNotFoundError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if self._discard(path):
+                total -= size
+
+    def clear(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
@@ -1,55 +1,251 @@
+import hashlib
 import json
 import os
-import requests
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+
 from viktor import File
 from viktor.core import Storage
 
+from disk_cache import DiskCache, hash_key
+from viktor_subdomain import http_transport
 from viktor_subdomain.helper_functions import set_environment_variables
 
 set_environment_variables()
 FORMA_PROJECT_ID = os.getenv("FORMA_PROJECT_ID", "pro_nz1xbbzv0p")
 FORMA_SECRET = os.getenv("FORMA_SECRET", "bkhFR0hMeDk4OTJUaXFsTFZaQmJjbEdjYUVwMUcya2Q6aXJMTDZrOXJ4elRGaTlnWA==")
+FORMA_OBJECT_CACHE_MAX_BYTES = int(os.getenv("FORMA_OBJECT_CACHE_MAX_BYTES", 512 * 1024 ** 2))
 
-def get_two_legged_aps_token() -> str:
-    two_legged_res = requests.post("https://developer.api.autodesk.com/authentication/v2/token",
-                                data={'grant_type': 'client_credentials', 'scope': "data:write"},
-                                headers={
-                                    'Content-Type': 'application/x-www-form-urlencoded',
-                                    'Accept': "application/json",
-                                    'Authorization': f"Basic {FORMA_SECRET}"})
-    two_legged_res.raise_for_status()
-    access_token = two_legged_res.json()["access_token"]
-    return access_token
+# downloaded storage objects (terrain, surroundings) by project and key, revalidated on every request
+forma_object_cache = DiskCache("forma-objects", max_bytes=FORMA_OBJECT_CACHE_MAX_BYTES)
 
+class ApsTokenProvider:
+    """Caches a two-legged APS access token until shortly before it expires.
 
-def get_terrain():
-    aps_token = get_two_legged_aps_token()
-    object_res = requests.get(f"https://app.autodeskforma.eu/api/extension-service/installations/8ad1d7f9-4e17-4485-aa14-f2217475b5e0/storage-objects/terrain.glb?authcontext={FORMA_PROJECT_ID}",allow_redirects=False, headers={"Authorization": f"Bearer {aps_token}"})
+    Thread-safe: when several threads need a new token at the same time, only one of them requests it and the others
+    wait for that token.
+    """
+
+    def __init__(self, base64_auth: str, scope: str = "data:write", refresh_margin: float = 60):
+        self.base64_auth = base64_auth
+        self.scope = scope
+        self.refresh_margin = refresh_margin
+        self._access_token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def get_token(self) -> str:
+        with self._lock:
+            if self._access_token is None or time.monotonic() >= self._expires_at - self.refresh_margin:
+                self._refresh()
+            return self._access_token
+
+    def invalidate(self, access_token: str = None) -> None:
+        """Forget the cached token, e.g. after the API rejected it.
+
+        With an access_token, the cached token is only forgotten if it is still that token, so a token that another
+        thread already refreshed is kept.
+        """
+        with self._lock:
+            if access_token is None or access_token == self._access_token:
+                self._access_token = None
+
+    def _refresh(self) -> None:
+        two_legged_res = http_transport.post("https://developer.api.autodesk.com/authentication/v2/token",
+                                    data={'grant_type': 'client_credentials', 'scope': self.scope},
+                                    headers={
+                                        'Content-Type': 'application/x-www-form-urlencoded',
+                                        'Accept': "application/json",
+                                        'Authorization': f"Basic {self.base64_auth}"})
+        two_legged_res.raise_for_status()
+        token = two_legged_res.json()
+        self._access_token = token["access_token"]
+        self._expires_at = time.monotonic() + token.get("expires_in", 0)
+
+
+_token_providers = {}
+_token_providers_lock = threading.Lock()
+
+
+def _get_token_provider(base64_auth: str = FORMA_SECRET) -> ApsTokenProvider:
+    with _token_providers_lock:
+        if base64_auth not in _token_providers:
+            _token_providers[base64_auth] = ApsTokenProvider(base64_auth)
+        return _token_providers[base64_auth]
+
+
+def get_two_legged_aps_token(base64_auth: str = FORMA_SECRET) -> str:
+    return _get_token_provider(base64_auth).get_token()
+
+
+def _authorized_get(url: str, **kwargs):
+    """GET with the cached APS token, with a new token once if the cached one was rejected, e.g. revoked early"""
+    provider = _get_token_provider()
+    aps_token = provider.get_token()
+    res = http_transport.get(url, headers={"Authorization": f"Bearer {aps_token}"}, **kwargs)
+    if res.status_code == 401:
+        provider.invalidate(aps_token)
+        res = http_transport.get(url, headers={"Authorization": f"Bearer {provider.get_token()}"}, **kwargs)
+    return res
+
+
+def _get_storage_object_url(key: str) -> str:
+    """Temporary download url of a storage object of the Forma extension"""
+    object_res = _authorized_get(f"https://app.autodeskforma.eu/api/extension-service/installations/8ad1d7f9-4e17-4485-aa14-f2217475b5e0/storage-objects/{key}?authcontext={FORMA_PROJECT_ID}", allow_redirects=False)
     object_res.raise_for_status()
-    redirect_url = object_res.headers['Location']
-    return File.from_url(redirect_url)
+    return object_res.headers['Location']
+
+
+def _read_cached_blob(folder):
+    with open(folder / "meta.json") as f:
+        meta = json.load(f)
+    return (folder / "blob").read_bytes(), meta
+
+
+def _write_blob(content: bytes, meta: dict):
+    def write(folder):
+        (folder / "blob").write_bytes(content)
+        with open(folder / "meta.json", "w") as f:
+            json.dump(meta, f)
+    return write
+
+
+def get_storage_object(key: str) -> File:
+    """Downloads a storage object, unless the locally cached copy is still up to date.
+
+    The cached copy is revalidated with its ETag / Last-Modified. If the server sends neither, the object is downloaded
+    and only the cache is refreshed.
+    """
+    cache_key = hash_key(FORMA_PROJECT_ID, key)
+    cached_content, cached_meta = None, {}
+    folder = forma_object_cache.lookup(cache_key)
+    if folder is not None:
+        try:
+            cached_content, cached_meta = _read_cached_blob(folder)
+        except FileNotFoundError:  # evicted by another process while reading
+            pass
+
+    headers = {}
+    if cached_content is not None:
+        if cached_meta.get("etag"):
+            headers["If-None-Match"] = cached_meta["etag"]
+        if cached_meta.get("last_modified"):
+            headers["If-Modified-Since"] = cached_meta["last_modified"]
+
+    res = http_transport.get(_get_storage_object_url(key), headers=headers)
+    if res.status_code == 304 and cached_content is not None:
+        return File.from_data(cached_content)
+    res.raise_for_status()
+
+    content = res.content
+    meta = {
+        "etag": res.headers.get("ETag"),
+        "last_modified": res.headers.get("Last-Modified"),
+        "content_length": len(content),
+        "sha256": hashlib.sha256(content).hexdigest(),
+    }
+    if meta != cached_meta:
+        forma_object_cache.store(cache_key, _write_blob(content, meta), replace=True)
+    return File.from_data(content)
+
+
+def get_terrain():
+    return get_storage_object("terrain.glb")
 
 
 def get_surroundings():
-    aps_token = get_two_legged_aps_token()
-    object_res = requests.get(f"https://app.autodeskforma.eu/api/extension-service/installations/8ad1d7f9-4e17-4485-aa14-f2217475b5e0/storage-objects/surroundings.glb?authcontext={FORMA_PROJECT_ID}",allow_redirects=False, headers={"Authorization": f"Bearer {aps_token}"})
+    return get_storage_object("surroundings.glb")
+
+
+def _request_upload_url(key: str) -> str:
+    object_res = _authorized_get(f"https://app.autodeskforma.eu/api/extension-service/installations/8ad1d7f9-4e17-4485-aa14-f2217475b5e0/storage-objects/{key}/upload-url?authcontext={FORMA_PROJECT_ID}", allow_redirects=False)
     object_res.raise_for_status()
-    redirect_url = object_res.headers['Location']
-    return File.from_url(redirect_url)
+    return object_res.json()["url"]
 
 
-def store_alternatives_forma(alternatives):
-    aps_token = get_two_legged_aps_token()
-    for alternative in alternatives:
-        object_res = requests.get(f"https://app.autodeskforma.eu/api/extension-service/installations/8ad1d7f9-4e17-4485-aa14-f2217475b5e0/storage-objects/alternatives-{i}.glb/upload-url?authcontext={FORMA_PROJECT_ID}",allow_redirects=False, headers={"Authorization": f"Bearer {aps_token}"})
-        object_res.raise_for_status()
-        url = object_res.json()["url"]
+def _upload(url: str, glb: bytes) -> None:
+    res = http_transport.post(url, data=glb, headers={"Content-Type": "model/gltf-binary"})
+    res.raise_for_status()
+
+
+def store_alternatives_forma(alternatives, max_in_flight=4, retries=2):
+    """Uploads the geometry of the alternatives to the extension storage as alternatives-<index>.glb
+
+    All upload urls are requested at once, then at most max_in_flight uploads run at the same time. A failed
+    alternative is retried with a fresh upload url. Returns the status per alternative, in the same order. Failures are
+    not raised, the caller checks "ok" of every status.
+    """
+    keys = [f"alternatives-{i}.glb" for i in range(len(alternatives))]
+    statuses = [{"key": key, "ok": False, "attempts": 0, "error": None} for key in keys]
+    if not alternatives:
+        return statuses
 
-        res = requests.post(url, data=alternative, headers={"Content-Type": "model/gltf-binary"})
-        res.raise_for_status()
+    with ThreadPoolExecutor(max_workers=len(alternatives)) as url_pool, \
+            ThreadPoolExecutor(max_workers=max_in_flight) as upload_pool:
 
+        def upload(i, url_future):
+            try:
+                _upload(url_future.result(), alternatives[i]["alternative"])
+            except Exception as e:
+                statuses[i]["error"] = repr(e)
+            else:
+                statuses[i].update(ok=True, error=None)
 
-def store_alternatives_viktor(alternatives):
+        pending = list(range(len(alternatives)))
+        for _ in range(retries + 1):
+            url_futures = {i: url_pool.submit(_request_upload_url, keys[i]) for i in pending}
+            upload_futures = []
+            for i in pending:
+                statuses[i]["attempts"] += 1
+                upload_futures.append(upload_pool.submit(upload, i, url_futures[i]))
+            wait(upload_futures)
+            pending = [i for i in pending if not statuses[i]["ok"]]
+            if not pending:
+                break
+    return statuses
+
+
+def _geometry_storage_key(glb: bytes, compressed: bool) -> str:
+    """Content address of a geometry, within the 64 character limit of storage keys"""
+    return f"glb-{hashlib.blake2b(glb, digest_size=20).hexdigest()}{'-z' if compressed else ''}"
+
+
+def store_alternatives_viktor(alternatives, compress=True):
+    """Stores a manifest with the score and parameters of every alternative, plus one blob per unique geometry.
+
+    Geometries are content-addressed, so a geometry that is already stored for this entity is not written again.
+    """
     storage = Storage()
-    storage_file = File.from_data(json.dumps(alternatives))
+    stored_keys = set(storage.list(prefix="glb-", scope='entity'))
+
+    manifest = []
+    for alternative in alternatives:
+        glb = alternative["alternative"]
+        key = _geometry_storage_key(glb, compress)
+        if key not in stored_keys:
+            storage.set(key, File.from_data(zlib.compress(glb) if compress else glb), scope='entity')
+            stored_keys.add(key)
+        manifest.append({
+            "score": float(alternative["score"]),
+            "options": dict(alternative.get("options") or {}),
+            "geometry": key,
+            "compressed": compress,
+            "size": len(glb),
+        })
+
+    storage_file = File.from_data(json.dumps({"version": 1, "alternatives": manifest}))
     storage.set('alternatives', storage_file, scope='entity')
+
+
+def load_alternatives_viktor() -> list:
+    """Score, parameters and geometry key of the stored alternatives, without reading any geometry"""
+    storage_file = Storage().get('alternatives', scope='entity')
+    return json.loads(storage_file.getvalue())["alternatives"]
+
+
+def load_alternative_geometry(alternative: dict) -> bytes:
+    """glb of an alternative from the manifest of load_alternatives_viktor"""
+    data = Storage().get(alternative["geometry"], scope='entity').getvalue_binary()
+    return zlib.decompress(data) if alternative["compressed"] else data
@@ -1,6 +1,11 @@
-from ShapeDiverTinySdk import ShapeDiverTinySessionSdk
-import requests
+import asyncio
+
+import trimesh
+
+from disk_cache import DiskCache, hash_key
+from ShapeDiverTinySdk import AsyncShapeDiverTinySessionSdk, ShapeDiverTinySessionSdk
 import os
+from viktor_subdomain import http_transport
 from viktor_subdomain.helper_functions import set_environment_variables
 
 
@@ -8,25 +13,111 @@ set_environment_variables()
 ticket = os.getenv("SD_TOKEN", "")
 modelViewUrl = "https://sdr7euc1.eu-central-1.shapediver.com"
 
+# the ShapeDiver model is a plain box of width x depth x height standing on z = 0, so it can be created locally.
+# Both the ShapeDiver model and the local box have a corner at the origin and extend along +x, +y and +z. The x and y
+# columns of the design options table are not sent to ShapeDiver, so neither path moves the model.
+SHAPEDIVER_MODEL_IS_BOX = os.getenv("SHAPEDIVER_MODEL_IS_BOX", "false").lower() in ("1", "true", "yes")
+GEOMETRY_CACHE_MAX_BYTES = int(os.getenv("GEOMETRY_CACHE_MAX_BYTES", 1024 ** 3))
 
-def generate_model(width, depth, height) -> bytes:
-    parameters = {
+# generated models by ShapeDiver parameters, shared by all runs and worker processes on this machine
+geometry_cache = DiskCache("geometry", max_bytes=GEOMETRY_CACHE_MAX_BYTES)
+
+
+def model_parameters(width, depth, height) -> dict:
+    return {
         "4fe28102-4ab7-4a35-8c93-9d39652d34c7": depth,
         "3d6526a1-9cac-4f4e-afa1-49661f2eba6a": width,
         "62837813-baca-4051-a934-5fc092319f3b": 0,
         "8944a4d2-573b-46c8-a3d1-237d74fa292d": height,
     }
 
+
+def _geometry_cache_key(parameters: dict) -> str:
+    """Key of the canonicalized parameters and the model ticket, numbers are compared by value (1 == 1.0)"""
+    canonical = {key: float(value) if isinstance(value, (int, float)) else value for key, value in parameters.items()}
+    return hash_key(modelViewUrl, ticket, canonical)
+
+
+def _get_cached_geometry(parameters: dict):
+    folder = geometry_cache.lookup(_geometry_cache_key(parameters))
+    if folder is None:
+        return None
+    try:
+        return (folder / "model.glb").read_bytes()
+    except FileNotFoundError:  # evicted by another process while reading
+        return None
+
+
+def _store_geometry(parameters: dict, glb: bytes) -> None:
+    geometry_cache.store(_geometry_cache_key(parameters), lambda folder: (folder / "model.glb").write_bytes(glb))
+
+
+def generate_model(width, depth, height) -> bytes:
+    """glb of the model, from the geometry cache or else generated by ShapeDiver"""
+    parameters = model_parameters(width, depth, height)
+    glb = _get_cached_geometry(parameters)
+    if glb is None:
+        glb = _generate_model(parameters)
+        _store_geometry(parameters, glb)
+    return glb
+
+
+def box_extents(width, depth, height):
+    """(x_min, y_min, x_max, y_max, top) of a box massing, with its corner at the origin like the ShapeDiver model"""
+    return 0, 0, width, depth, height
+
+
+def generate_box_model(width, depth, height) -> bytes:
+    """glb of a box massing, created locally instead of by ShapeDiver"""
+    x_min, y_min, x_max, y_max, top = box_extents(width, depth, height)
+    box = trimesh.creation.box(bounds=[[x_min, y_min, 0], [x_max, y_max, top]])
+    return box.export(file_type="glb")
+
+
+def _generate_model(parameters: dict) -> bytes:
     shapeDiverSessionSdk = ShapeDiverTinySessionSdk(
         modelViewUrl=modelViewUrl, ticket=ticket
     )
-
-    contentItemsGltf2 = shapeDiverSessionSdk.output(
-        paramDict=parameters
-    ).outputContentItemsGltf2()
+    try:
+        contentItemsGltf2 = shapeDiverSessionSdk.output(
+            paramDict=parameters
+        ).outputContentItemsGltf2()
+    finally:
+        shapeDiverSessionSdk.close()
 
     href = contentItemsGltf2[0]["href"]
 
-    res = requests.get(href)
+    res = http_transport.get(href)
+    res.raise_for_status()
 
     return res.content
+
+
+async def generate_models_async(dimensions, max_concurrency=8, transport=None) -> list:
+    """Generates the models for a list of (width, depth, height) in one ShapeDiver session, in the same order
+
+    Models that are in the geometry cache are not requested from ShapeDiver. If all are cached, no session is opened.
+    """
+    parameters = [model_parameters(*dimension) for dimension in dimensions]
+    models = [_get_cached_geometry(parameter) for parameter in parameters]
+    missing = [index for index, model in enumerate(models) if model is None]
+    if not missing:
+        return models
+
+    async with AsyncShapeDiverTinySessionSdk(
+        modelViewUrl=modelViewUrl, ticket=ticket, maxConcurrency=max_concurrency, transport=transport
+    ) as shapeDiverSessionSdk:
+
+        async def generate(index) -> None:
+            response = await shapeDiverSessionSdk.output(paramDict=parameters[index])
+            href = response.outputContentItemsGltf2()[0]["href"]
+            models[index] = await shapeDiverSessionSdk.download(href)
+            _store_geometry(parameters[index], models[index])
+
+        await asyncio.gather(*[generate(index) for index in missing])
+    return models
+
+
+def generate_models(dimensions, max_concurrency=8) -> list:
+    """Synchronous wrapper of generate_models_async"""
+    return asyncio.run(generate_models_async(dimensions, max_concurrency=max_concurrency))
@@ -1,21 +1,31 @@
-import time
-import requests
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import os
 
-from viktor import File, progress_message
+from viktor import File, UserError, progress_message
 from viktor.utils import memoize
 
-from generate_model import generate_model
-from height_map_utils import crop_map, merge_maps
+from generate_model import SHAPEDIVER_MODEL_IS_BOX, box_extents, generate_box_model, generate_model, generate_models
+from height_map_utils import box_height_map, crop_map, height_map_grid, merge_maps, patch_map
+from height_map_cache import cached_gltf_raytrace, height_map_cache
+from pipeline import Pipeline
 from raytrace import gltf_raytrace, get_trimesh_object
 from forma_storage import get_terrain, get_surroundings, store_alternatives_forma, store_alternatives_viktor
+from wind_analysis import analyze_wind_comfort, get_stats as get_wind_analysis_stats
 from viktor_subdomain.helper_functions import set_environment_variables
 
 set_environment_variables()
 forma_base_url = "https://app.autodeskforma.eu"
 FORMA_PROJECT_ID = os.getenv("FORMA_PROJECT_ID", "pro_nz1xbbzv0p")
 FORMA_TOKEN = os.getenv("FORMA_TOKEN", "bkhFR0hMeDk4OTJUaXFsTFZaQmJjbEdjYUVwMUcya2Q6aXJMTDZrOXJ4elRGaTlnWA==")
+# number of design options that are evaluated at the same time, 1 evaluates them one after another
+DESIGN_OPTION_WORKERS = int(os.getenv("DESIGN_OPTION_WORKERS", min(4, os.cpu_count() or 1)))
+# send the height maps to the Forma wind surrogate, otherwise every pixel gets the same placeholder result
+FORMA_WIND_ANALYSIS = os.getenv("FORMA_WIND_ANALYSIS", "false").lower() in ("1", "true", "yes")
+# the ray-tracing processes are started from a pipeline thread, forking there would copy locks held by other threads
+RAYTRACE_PROCESS_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
 
 def get_wind_parameters():
     # res = requests.get(
@@ -84,62 +94,141 @@ def get_wind_parameters():
 
 
 def analyze(terrain_height_map, terrain_and_buildings_height_map):
+    if not FORMA_WIND_ANALYSIS:
+        return np.ma.masked_array(np.ones(terrain_height_map["map"].shape), mask=terrain_height_map["mask"])
 
-    return np.ma.masked_array(np.array([[1]*200]*200), mask=terrain_height_map == 0)
+    return analyze_wind_comfort(terrain_height_map, terrain_and_buildings_height_map, get_wind_parameters())
 
-    min_height = min(terrain_and_buildings_height_map.min(), terrain_height_map.min())
-    max_height = max(terrain_and_buildings_height_map.max(), terrain_height_map.max())
 
-    normalized_terrain_and_buildings_height_map = [
-        round((x - min_height) / (max_height - min_height))
-        for x in terrain_and_buildings_height_map.flatten().tolist()
-    ]
-    normalized_terrain_height_map = [
-        round((x - min_height) / (max_height - min_height)) for x in terrain_height_map.flatten().tolist()
+@memoize
+def create_geometry(options) -> bytes:
+    return generate_model(options["width"], options["depth"], options["height"])
+
+
+def prefetch_geometries(design_options) -> None:
+    """Generates the geometry of all design options in one ShapeDiver session, into the geometry cache.
+
+    create_geometry then finds every geometry in the cache, instead of opening a session per design option.
+    """
+    dimensions = {(options["width"], options["depth"], options["height"]): None for options in design_options}
+    generate_models(list(dimensions))
+
+
+def _box_dimensions(options):
+    """(width, depth, height) of a design option, the same parameters that are sent to ShapeDiver"""
+    return options["width"], options["depth"], options["height"]
+
+
+def create_height_map(glb: bytes, grid):
+    """Height map of the footprint of a design option on the site grid.
+
+    Module level function taking bytes, so it can run in a worker process.
+    """
+    return gltf_raytrace(glb=File.from_data(glb), footprint_grid=grid)
+
+
+def design_option_stages(terrain_height_map, site_height_map, raytrace=create_height_map, box=SHAPEDIVER_MODEL_IS_BOX):
+    """The steps to evaluate a design option, as (name, function) pairs that each take and return the state dict.
+
+    The state starts as {"options": ...} and ends as the alternative with its score. raytrace(glb, grid) creates the
+    height map of the geometry on the pixels of the site grid that it covers, which is patched onto the height map of
+    the terrain with its surroundings.
+
+    With box, the design options are box massings: their height is written directly into the grid and the glb is
+    only created locally for the result, without ShapeDiver and ray-tracing.
+    """
+    grid = height_map_grid(site_height_map)
+
+    def geometry(state):
+        if not box:
+            state["alternative"] = create_geometry(state["options"])
+        return state
+
+    def height_map(state):
+        if box:
+            state["height_map"] = box_height_map(grid, *box_extents(*_box_dimensions(state["options"])))
+        else:
+            state["height_map"] = raytrace(state["alternative"], grid)
+        return state
+
+    def processing(state):
+        state["terrain_height_map_cropped"] = crop_map(terrain_height_map)
+        merged_height_map = patch_map(site_height_map, state.pop("height_map"))
+        state["merged_height_map_cropped"] = crop_map(merged_height_map)
+        return state
+
+    def analysis(state):
+        state["analyze_result"] = analyze(
+            state.pop("terrain_height_map_cropped"), state.pop("merged_height_map_cropped")
+        )
+        return state
+
+    def score(state):
+        if box:
+            state["alternative"] = generate_box_model(*_box_dimensions(state["options"]))
+        return {"alternative": state["alternative"], "score": evaluate(state["analyze_result"]),
+                "options": state["options"]}
+
+    return [
+        ("Create geometry", geometry),
+        ("Ray-tracing", height_map),
+        ("Processing", processing),
+        ("Analyzing", analysis),
+        ("Scoring", score),
     ]
 
-    start = time.time()
-    res = requests.post(
-        f"{forma_base_url}/api/surrogate/forma-wind-core/experimental?authcontext={FORMA_PROJECT_ID}&direction=0&analysisType=comfort&comfortScale=lawson_lddc",
-        headers={"Authorization": "Bearer " + FORMA_TOKEN},
-        json={
-            "heightMaps": {
-                "terrainHeightArray": normalized_terrain_height_map,
-                "buildingAndTerrainHeightArray": normalized_terrain_and_buildings_height_map,
-                "minHeight": int(min_height),
-                "maxHeight": int(max_height),
-            },
-            "windRose": get_wind_parameters(),
-            "type": "comfort",
-            "roughness": 0.4978,
-            "comfortScale": "lawson_lddc",
-        },
-    )
-    end = time.time()
-    print(end - start)
 
-    res.raise_for_status()
+def evaluate_design_option(options, terrain_height_map, site_height_map, progress=None):
+    """Creates the geometry of a design option, analyzes it and returns the alternative with its score.
 
-    data = res.json()
+    progress(step) is called before every step.
+    """
+    state = {"options": options}
+    for step, function in design_option_stages(terrain_height_map, site_height_map):
+        if progress is not None:
+            progress(step)
+        state = function(state)
+    return state
 
-    arr = np.array(data["heatmap_data"])
-    masked = np.ma.masked_array(arr, mask=data["heatmap_mask"])
 
-    return masked
+def evaluate_design_options_concurrently(design_options, terrain_height_map, site_height_map, max_workers):
+    """Evaluates the design options in a pipeline and returns the alternatives in the order of the design options,
+    with the statistics of the pipeline: per step the Pipeline.stats, and the bottleneck step.
 
+    Every step runs in its own worker threads, connected by bounded queues, so while one option is analyzed the next
+    is ray-traced and the one after that is generated in ShapeDiver. Ray-tracing itself runs in a process pool.
+    Progress, with the queue depth per step, is reported from the calling thread.
+    """
+    mp_context = multiprocessing.get_context(RAYTRACE_PROCESS_START_METHOD)
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as process_pool:
 
-@memoize
-def create_geometry(options) -> bytes:
-    return generate_model(options["width"], options["depth"], options["height"])
+        def raytrace_in_process(glb, grid):
+            return process_pool.submit(create_height_map, glb, grid).result()
+
+        stages = design_option_stages(terrain_height_map, site_height_map, raytrace=raytrace_in_process)
+        # merging and cropping is quick NumPy work, a single worker keeps up with the other steps
+        stages[2] = (*stages[2], 1)
+        pipeline = Pipeline(stages, workers=max_workers, queue_size=max_workers)
 
+        def on_progress(number_finished, stats):
+            queued = ", ".join(f"{step}: {stage['queue_depth']}" for step, stage in stats.items())
+            progress_message(f"Design options {number_finished}/{len(design_options)} done. Queued: {queued}")
 
-def create_height_map(glb):
-    return 
+        alternatives = pipeline.run([{"options": options} for options in design_options], on_progress=on_progress)
 
+    bottleneck = pipeline.bottleneck()
+    progress_message(f"Design options {len(design_options)}/{len(design_options)} done. Slowest step: {bottleneck}")
+    return alternatives, {"steps": pipeline.stats(), "bottleneck": bottleneck}
 
-def generate(params):
-    alternatives = []
 
+def generate(params, max_workers=DESIGN_OPTION_WORKERS) -> dict:
+    """Evaluates the design options and stores them as alternatives in Forma and VIKTOR.
+
+    Returns statistics of the run, to log or show them: "height_map_cache" with the hits and misses of the height map
+    cache, "pipeline" with the result of evaluate_design_options_concurrently, if the design options were evaluated
+    concurrently, and "wind_analysis" with wind_analysis.get_stats, if the wind analysis is enabled.
+    """
+    run_stats = {}
     progress_message('Retrieve terrain...')
     terrain_glb = get_terrain()
     progress_message('Retrieve surroundings')
@@ -147,36 +236,42 @@ def generate(params):
 
     progress_message('Ray-tracing terrain...')
     terrain_mesh = get_trimesh_object(glb=terrain_glb)
-    scene = terrain_mesh.scene()
-    bounds = scene.bounding_box.bounds
-    terrain_height_map = gltf_raytrace(glb=terrain_glb, bounding_box=bounds)
+    bounds = terrain_mesh.bounds
+    terrain_height_map = cached_gltf_raytrace(terrain_glb, bounding_box=bounds, mesh=terrain_mesh)
     progress_message('Ray-tracing surroundings...')
-    surrounding_height_map = gltf_raytrace(glb=surrounding_glb, bounding_box=bounds)
-
-    for idx, options in enumerate(params.analysis.design_options, start=1):
-        progress_message(f"Design option {idx}: Create geometry...")
-        alternative_glb: bytes = create_geometry(options)
-
-        progress_message(f"Design option {idx}: Ray-tracing...")
-        alternative_height_map = gltf_raytrace(glb=File.from_data(alternative_glb), bounding_box=bounds)
-
-        progress_message(f"Design option {idx}: Processing...")
-        terrain_height_map_cropped = crop_map(terrain_height_map["map"])
-        merged_height_map = merge_maps(
-            terrain_height_map, surrounding_height_map, alternative_height_map
+    surrounding_height_map = cached_gltf_raytrace(surrounding_glb, bounding_box=bounds)
+    run_stats["height_map_cache"] = height_map_cache.stats()
+    # the site is the same for every design option, only the footprint of the design option is traced on top of it
+    site_height_map = merge_maps(terrain_height_map, surrounding_height_map)
+
+    design_options = params.analysis.design_options
+    if not SHAPEDIVER_MODEL_IS_BOX:
+        progress_message('Generating geometry...')
+        prefetch_geometries(design_options)
+    # box massings take milliseconds per option, a pipeline with a process pool would only add overhead
+    if max_workers > 1 and len(design_options) > 1 and not SHAPEDIVER_MODEL_IS_BOX:
+        alternatives, run_stats["pipeline"] = evaluate_design_options_concurrently(
+            design_options, terrain_height_map, site_height_map, max_workers
         )
-        merged_height_map_cropped = crop_map(merged_height_map)
-
-        progress_message(f"Design option {idx}: Analyzing...")
-        analyze_result = analyze(terrain_height_map_cropped, merged_height_map_cropped)
-
-        score = evaluate(analyze_result)
+    else:
+        alternatives = []
+        for idx, options in enumerate(design_options, start=1):
+            progress = lambda step, idx=idx: progress_message(f"Design option {idx}: {step}...")
+            alternatives.append(
+                evaluate_design_option(options, terrain_height_map, site_height_map, progress=progress)
+            )
 
-        alternatives.append({"alternative": alternative_glb, "score": score})
+    if FORMA_WIND_ANALYSIS:
+        run_stats["wind_analysis"] = get_wind_analysis_stats()
 
     progress_message(f"Saving results to Forma and VIKTOR...")
-    store_alternatives_forma(alternatives[0:5])
+    forma_statuses = store_alternatives_forma(alternatives[0:5])
     store_alternatives_viktor(alternatives)
+    failed = [status for status in forma_statuses if not status["ok"]]
+    if failed:
+        raise UserError(f"Failed to store {', '.join(status['key'] for status in failed)} in Forma: "
+                        f"{failed[-1]['error']}")
+    return run_stats
 
 
 def evaluate(analysis_result):
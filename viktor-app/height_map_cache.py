@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+from viktor import File
+
+from disk_cache import DiskCache, hash_key
+from height_map_utils import make_height_map
+from raytrace import gltf_raytrace
+
+HEIGHT_MAP_CACHE_MAX_BYTES = int(os.getenv("HEIGHT_MAP_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+height_map_cache = DiskCache("height-maps", max_bytes=HEIGHT_MAP_CACHE_MAX_BYTES)
+# arguments of gltf_raytrace that do not change the height map, all other arguments are part of the cache key. mesh is
+# expected to be the geometry of the glb.
+_UNKEYED_ARGUMENTS = ("mesh", "memory_budget", "workers", "out_dir")
+
+
+def _keyed_arguments(kwargs) -> dict:
+    keyed = {name: value for name, value in kwargs.items() if name not in _UNKEYED_ARGUMENTS}
+    if keyed.get("footprint_grid") is not None:
+        grid = keyed["footprint_grid"]
+        keyed["footprint_grid"] = {name: np.asarray(grid[name], dtype=float).tolist()
+                                   for name in ("origin", "resolution", "shape")}
+    return keyed
+
+
+def _write_height_map(height_map):
+    def write(folder):
+        np.save(folder / "map.npy", height_map["map"])
+        np.save(folder / "mask.npy", height_map["mask"])
+        with open(folder / "meta.json", "w") as f:
+            json.dump({"origin": height_map["origin"], "resolution": height_map["resolution"],
+                       "backend": height_map.get("backend"), "rays": height_map.get("rays")}, f)
+    return write
+
+
+def _read_height_map(folder):
+    with open(folder / "meta.json") as f:
+        meta = json.load(f)
+    return make_height_map(
+        np.load(folder / "map.npy", mmap_mode="r"), np.load(folder / "mask.npy", mmap_mode="r"),
+        meta["origin"], meta["resolution"], backend=meta["backend"], rays=meta.get("rays"),
+    )
+
+
+def cached_gltf_raytrace(glb: File, bounding_box=None, discretization_value=1.5, method='ray', **kwargs):
+    """gltf_raytrace backed by the on-disk height map cache.
+
+    The key is the hash of the glb content, the bounding box, the discretization value, the method and the other
+    arguments that change the height map, e.g. tolerance and coarse_factor. Cached maps are memory-mapped read-only, so
+    they should not be modified in place.
+    """
+    content_hash = hashlib.sha256(glb.getvalue_binary()).hexdigest()
+    bounds = None if bounding_box is None else np.asarray(bounding_box, dtype=float).tolist()
+    key = hash_key(content_hash, bounds, float(discretization_value), method, _keyed_arguments(kwargs))
+
+    folder = height_map_cache.lookup(key)
+    if folder is not None:
+        try:
+            return _read_height_map(folder)
+        except FileNotFoundError:  # evicted by another process while reading
+            pass
+
+    height_map = gltf_raytrace(glb=glb, bounding_box=bounding_box, discretization_value=discretization_value,
+                               method=method, **kwargs)
+    height_map_cache.store(key, _write_height_map(height_map))
+    return height_map
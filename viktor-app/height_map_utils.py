@@ -1,34 +1,130 @@
 import numpy as np
 
 
+def make_height_map(elevation, mask, origin, resolution, **extra):
+    """Height map dict with the absolute elevation per pixel.
+
+    map: float32 elevation, 0 where there is no geometry
+    mask: True where there is no geometry (nodata), same convention as numpy masked arrays
+    origin: (x, y) coordinate of pixel [0, 0]
+    resolution: (dx, dy) pixel size
+    x, y: kept for backwards compatibility, the x-max and y-min of the grid
+    """
+    elevation = np.asarray(elevation, dtype=np.float32)
+    mask = np.asarray(mask, dtype=bool)
+    origin = (float(origin[0]), float(origin[1]))
+    resolution = (float(resolution[0]), float(resolution[1]))
+    x_max = origin[0] + (elevation.shape[0] - 1) * resolution[0]
+    return {"x": x_max, "y": origin[1], "map": elevation, "mask": mask, "origin": origin, "resolution": resolution,
+            **extra}
+
+
+def height_map_grid(height_map):
+    """Origin, resolution and shape of the grid of a height map, e.g. to trace other geometry on the same pixels"""
+    return {"origin": height_map["origin"], "resolution": height_map["resolution"],
+            "shape": tuple(height_map["map"].shape)}
+
+
+def patch_map(base, *patches):
+    """Height map of the base with the patches on top, without copying the base.
+
+    The result only refers to the base and the patches, crop_map and materialize_map merge them for the part that is
+    actually used. The patches should be on the grid of the base, see raytrace.footprint_axes.
+    """
+    if "patches" in base:
+        return {"base": base["base"], "patches": base["patches"] + list(patches)}
+    return {"base": base, "patches": list(patches)}
+
+
+def materialize_map(height_map):
+    """Plain height map of a patched height map"""
+    if "patches" in height_map:
+        return merge_maps(height_map["base"], *height_map["patches"])
+    return height_map
+
+
+def box_height_map(grid, x_min, y_min, x_max, y_max, top):
+    """Height map of an axis-aligned box with its top at top, on the pixels of the grid within its footprint.
+
+    Same result as ray-tracing the box on the grid (see raytrace.footprint_axes), without any geometry.
+    """
+    first, last = [], []
+    for axis, (low, high) in enumerate([(x_min, x_max), (y_min, y_max)]):
+        origin, step, n = grid["origin"][axis], grid["resolution"][axis], grid["shape"][axis]
+        first.append(int(np.clip(np.ceil((low - origin) / step), 0, n)))
+        last.append(int(np.clip(np.floor((high - origin) / step) + 1, first[axis], n)))
+    shape = (last[0] - first[0], last[1] - first[1])
+    origin = [grid["origin"][axis] + first[axis] * grid["resolution"][axis] for axis in range(2)]
+    return make_height_map(np.full(shape, top), np.zeros(shape, dtype=bool), origin, grid["resolution"])
+
+
+def as_masked_array(height_map):
+    """The elevation of the height map as numpy masked array"""
+    return np.ma.masked_array(height_map["map"], mask=height_map["mask"])
+
+
+def height_map_to_image(height_map):
+    """Grey scale uint8 image of the height map, scaled to its own elevation range. Higher is darker, nodata is 0"""
+    image = np.zeros(height_map["map"].shape, dtype=np.uint8)
+    valid = ~height_map["mask"]
+    if valid.any():
+        elevation = height_map["map"][valid].astype(np.float64)
+        depth = elevation.max() - elevation
+        depth_range = np.ptp(depth)
+        depth_float = (depth - depth.min()) / depth_range if depth_range else np.zeros_like(depth)
+        image[valid] = (depth_float * 255).round().astype(np.uint8)
+    return image
+
+
+def _pixel_offset(height_map, other):
+    """Offset in pixels of the origin of other with respect to the origin of height_map"""
+    return tuple(
+        int(round((other["origin"][axis] - height_map["origin"][axis]) / height_map["resolution"][axis]))
+        for axis in range(2)
+    )
+
+
 def crop_map(height_map, size=500):
-    [w, h] = height_map.shape
+    if "patches" in height_map:
+        # only the cropped part of the base is copied to apply the patches on
+        return merge_maps(crop_map(height_map["base"], size), *height_map["patches"])
+
+    [w, h] = height_map["map"].shape
 
-    sx = int(w / 2 - size / 2)
-    sy = int(h / 2 - size / 2)
+    sx = max(int(w / 2 - size / 2), 0)
+    sy = max(int(h / 2 - size / 2), 0)
 
-    return height_map[sx : sx + size, sy : sy + size]
+    dx, dy = height_map["resolution"]
+    origin = (height_map["origin"][0] + sx * dx, height_map["origin"][1] + sy * dy)
+    return make_height_map(
+        height_map["map"][sx : sx + size, sy : sy + size],
+        height_map["mask"][sx : sx + size, sy : sy + size],
+        origin,
+        height_map["resolution"],
+    )
 
 
-def merge_maps(terrain, surroundings, alternative):
+def merge_maps(terrain, *layers):
+    """Merges height maps onto the grid of the terrain, keeping the top-most surface of every pixel"""
     out = terrain["map"].copy()
-    x, y = terrain["x"], terrain["y"]
-
-    sx = int(round(surroundings["x"] - x))
-    sy = int(round(surroundings["y"] - y))
-    [w, h] = surroundings["map"].shape
-
-    out[sx : sx + w, sy : sy + h] += surroundings["map"]
-
-    sx = alternative["x"] - x
-    sy = alternative["y"] - y
-    [w, h] = alternative["map"].shape
-    print(alternative["map"].shape)
-    print(sx)
-    print(w)
-    print(sy)
-    print(h)
-    print(out[int(sx) : int(sx + w), int(sy) : int(sy + h)].shape)
-    out[int(sx) : int(sx + w), int(sy) : int(sy + h)] += alternative["map"]
-
-    return out
+    mask = terrain["mask"].copy()
+
+    for layer in layers:
+        sx, sy = _pixel_offset(terrain, layer)
+        [w, h] = layer["map"].shape
+
+        # part of the layer that falls within the terrain grid
+        x0, y0 = max(sx, 0), max(sy, 0)
+        x1, y1 = min(sx + w, out.shape[0]), min(sy + h, out.shape[1])
+        if x0 >= x1 or y0 >= y1:
+            continue
+        layer_map = layer["map"][x0 - sx : x1 - sx, y0 - sy : y1 - sy]
+        layer_mask = layer["mask"][x0 - sx : x1 - sx, y0 - sy : y1 - sy]
+
+        target_map = out[x0:x1, y0:y1]
+        target_mask = mask[x0:x1, y0:y1]
+        on_top = ~layer_mask & (target_mask | (layer_map > target_map))
+        target_map[on_top] = layer_map[on_top]
+        target_mask &= layer_mask
+
+    return make_height_map(out, mask, terrain["origin"], terrain["resolution"])
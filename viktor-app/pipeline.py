@@ -0,0 +1,135 @@
+import queue
+import threading
+import time
+
+_DONE = object()  # sentinel that tells a stage worker there is no more input
+
+
+class _Failed:
+    """Marks an item of which an earlier stage raised, so later stages pass it on without processing it"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class _Stage:
+
+    def __init__(self, name, function, workers, queue_size):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.input = queue.Queue(maxsize=queue_size)
+        self.processed = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+        self.running_workers = workers
+        self.lock = threading.Lock()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "processed": self.processed,
+                "busy_seconds": self.busy_seconds,
+                "mean_seconds": self.busy_seconds / self.processed if self.processed else 0.0,
+                "queue_depth": self.input.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+            }
+
+
+class Pipeline:
+    """Runs items through a sequence of stages, each with its own worker threads.
+
+    Stages are connected with bounded queues, so a stage that is slower than the previous one makes that stage wait
+    instead of piling up work in memory, while all stages work on different items at the same time. Stages are given
+    as (name, function) or (name, function, workers); every function takes the output of the previous stage.
+    """
+
+    def __init__(self, stages, workers=1, queue_size=2):
+        self._stages = [
+            _Stage(stage[0], stage[1], stage[2] if len(stage) > 2 else workers, queue_size) for stage in stages
+        ]
+
+    def stats(self) -> dict:
+        """Per stage the number of processed items, time spent processing, and current and max input queue depth"""
+        return {stage.name: stage.stats() for stage in self._stages}
+
+    def bottleneck(self) -> str:
+        """Name of the stage with the most processing time per worker"""
+        return max(self._stages, key=lambda stage: stage.busy_seconds / stage.workers).name
+
+    def run(self, items, on_progress=None, progress_interval=1.0) -> list:
+        """Runs all items through the pipeline and returns the results in the order of the items.
+
+        on_progress(number_of_finished_items, stats) is called from the calling thread every progress_interval seconds.
+        The first error raised by any stage is raised again once all items are through the pipeline.
+        """
+        items = list(items)
+        results = {}
+        for stage in self._stages:
+            stage.running_workers = stage.workers
+        finished = threading.Condition()
+
+        def put(index, value, next_stage):
+            if next_stage is None:
+                with finished:
+                    results[index] = value
+                    finished.notify_all()
+            else:
+                next_stage.input.put((index, value))
+                with next_stage.lock:
+                    next_stage.max_queue_depth = max(next_stage.max_queue_depth, next_stage.input.qsize())
+
+        def work(stage, next_stage):
+            while True:
+                entry = stage.input.get()
+                if entry is _DONE:
+                    break
+                index, value = entry
+                if not isinstance(value, _Failed):
+                    start = time.perf_counter()
+                    try:
+                        value = stage.function(value)
+                    except Exception as e:
+                        value = _Failed(e)
+                    with stage.lock:
+                        stage.processed += 1
+                        stage.busy_seconds += time.perf_counter() - start
+                put(index, value, next_stage)
+
+            # the last worker of a stage to finish tells the workers of the next stage to stop
+            with stage.lock:
+                stage.running_workers -= 1
+                last = stage.running_workers == 0
+            if last and next_stage is not None:
+                for _ in range(next_stage.workers):
+                    next_stage.input.put(_DONE)
+
+        def feed():
+            first = self._stages[0]
+            for index, item in enumerate(items):
+                put(index, item, first)
+            for _ in range(first.workers):
+                first.input.put(_DONE)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for stage, next_stage in zip(self._stages, self._stages[1:] + [None]):
+            threads += [threading.Thread(target=work, args=(stage, next_stage), daemon=True)
+                        for _ in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+
+        while True:
+            with finished:
+                finished.wait_for(lambda: len(results) >= len(items), timeout=progress_interval)
+                number_finished = len(results)
+            if on_progress is not None:
+                on_progress(number_finished, self.stats())
+            if number_finished >= len(items):
+                break
+        for thread in threads:
+            thread.join()
+
+        for index in range(len(items)):
+            if isinstance(results[index], _Failed):
+                raise results[index].error
+        return [results[index] for index in range(len(items))]
@@ -0,0 +1,110 @@
+import os
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# memory for the temporary arrays of the NumPy rasterizer, which take about 220 bytes per (triangle, pixel) pair
+RASTER_MEMORY_BUDGET = int(os.getenv("RASTER_MEMORY_BUDGET", 32 * 1024 ** 2))
+# upper bound on the number of candidate (triangle, pixel) pairs evaluated at once by the NumPy rasterizer
+CHUNK_SIZE = max(RASTER_MEMORY_BUDGET // 256, 1024)
+# tolerance on the barycentric coordinates, so pixels exactly on a shared edge are not missed
+EDGE_TOLERANCE = 1e-9
+
+
+def _pixel_ranges(triangles_xy, x0, dx, nx, y0, dy, ny):
+    """First and last pixel index covered by the xy bounding box of each triangle"""
+    i_min = np.clip(np.ceil((triangles_xy[:, :, 0].min(axis=1) - x0) / dx), 0, nx).astype(np.int64)
+    i_max = np.clip(np.floor((triangles_xy[:, :, 0].max(axis=1) - x0) / dx), -1, nx - 1).astype(np.int64)
+    j_min = np.clip(np.ceil((triangles_xy[:, :, 1].min(axis=1) - y0) / dy), 0, ny).astype(np.int64)
+    j_max = np.clip(np.floor((triangles_xy[:, :, 1].max(axis=1) - y0) / dy), -1, ny - 1).astype(np.int64)
+    return i_min, i_max, j_min, j_max
+
+
+def _rasterize_numpy(triangles, x0, dx, nx, y0, dy, ny):
+    zbuffer = np.full(nx * ny, -np.inf)
+    i_min, i_max, j_min, j_max = _pixel_ranges(triangles[:, :, :2], x0, dx, nx, y0, dy, ny)
+    width = np.maximum(i_max - i_min + 1, 0)
+    height = np.maximum(j_max - j_min + 1, 0)
+    counts = width * height
+
+    # vertical faces have no area seen from above and never end up on top
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    area = (b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (c[:, 0] - a[:, 0]) * (b[:, 1] - a[:, 1])
+    counts[np.abs(area) < 1e-12] = 0
+
+    candidates = np.flatnonzero(counts)
+    cumulative = np.cumsum(counts[candidates])
+    start = 0
+    while start < len(candidates):
+        stop = np.searchsorted(cumulative, cumulative[start] - counts[candidates[start]] + CHUNK_SIZE, side='right')
+        chunk = candidates[start:max(stop, start + 1)]
+        start += len(chunk)
+
+        # one row per (triangle, pixel) pair inside the bounding box of that triangle
+        tri = np.repeat(chunk, counts[chunk])
+        offsets = np.arange(len(tri)) - np.repeat(np.cumsum(counts[chunk]) - counts[chunk], counts[chunk])
+        i = i_min[tri] + offsets // height[tri]
+        j = j_min[tri] + offsets % height[tri]
+        px = x0 + i * dx
+        py = y0 + j * dy
+
+        # barycentric coordinates of the pixel centre
+        ta, tb, tc = a[tri], b[tri], c[tri]
+        w_b = ((px - ta[:, 0]) * (tc[:, 1] - ta[:, 1]) - (tc[:, 0] - ta[:, 0]) * (py - ta[:, 1])) / area[tri]
+        w_c = ((tb[:, 0] - ta[:, 0]) * (py - ta[:, 1]) - (px - ta[:, 0]) * (tb[:, 1] - ta[:, 1])) / area[tri]
+        w_a = 1 - w_b - w_c
+        inside = (w_a >= -EDGE_TOLERANCE) & (w_b >= -EDGE_TOLERANCE) & (w_c >= -EDGE_TOLERANCE)
+
+        z = w_a * ta[:, 2] + w_b * tb[:, 2] + w_c * tc[:, 2]
+        np.maximum.at(zbuffer, (i * ny + j)[inside], z[inside])
+    return zbuffer.reshape(nx, ny)
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _rasterize_numba(triangles, x0, dx, nx, y0, dy, ny):
+        zbuffer = np.full((nx, ny), -np.inf)
+        for t in range(triangles.shape[0]):
+            ax, ay, az = triangles[t, 0, 0], triangles[t, 0, 1], triangles[t, 0, 2]
+            bx, by, bz = triangles[t, 1, 0], triangles[t, 1, 1], triangles[t, 1, 2]
+            cx, cy, cz = triangles[t, 2, 0], triangles[t, 2, 1], triangles[t, 2, 2]
+            area = (bx - ax) * (cy - ay) - (cx - ax) * (by - ay)
+            if abs(area) < 1e-12:
+                continue
+            i_min = max(int(np.ceil((min(ax, bx, cx) - x0) / dx)), 0)
+            i_max = min(int(np.floor((max(ax, bx, cx) - x0) / dx)), nx - 1)
+            j_min = max(int(np.ceil((min(ay, by, cy) - y0) / dy)), 0)
+            j_max = min(int(np.floor((max(ay, by, cy) - y0) / dy)), ny - 1)
+            for i in range(i_min, i_max + 1):
+                px = x0 + i * dx
+                for j in range(j_min, j_max + 1):
+                    py = y0 + j * dy
+                    w_b = ((px - ax) * (cy - ay) - (cx - ax) * (py - ay)) / area
+                    w_c = ((bx - ax) * (py - ay) - (px - ax) * (by - ay)) / area
+                    w_a = 1 - w_b - w_c
+                    if w_a >= -EDGE_TOLERANCE and w_b >= -EDGE_TOLERANCE and w_c >= -EDGE_TOLERANCE:
+                        z = w_a * az + w_b * bz + w_c * cz
+                        if z > zbuffer[i, j]:
+                            zbuffer[i, j] = z
+        return zbuffer
+
+
+def rasterize_top_z(mesh, origin_x, origin_y, use_numba=None):
+    """Z-buffer of the top-most surface of the mesh, sampled on the regular grid origin_x * origin_y.
+
+    Pixels without any geometry above them are -inf. Uses numba when it is installed, unless use_numba is False.
+    Returns the z-buffer and the name of the engine that is used.
+    """
+    triangles = np.ascontiguousarray(mesh.triangles, dtype=np.float64)
+    nx, ny = len(origin_x), len(origin_y)
+    dx = (origin_x[-1] - origin_x[0]) / (nx - 1) if nx > 1 else 1.0
+    dy = (origin_y[-1] - origin_y[0]) / (ny - 1) if ny > 1 else 1.0
+    if use_numba is None:
+        use_numba = numba is not None
+    if use_numba:
+        return _rasterize_numba(triangles, origin_x[0], dx, nx, origin_y[0], dy, ny), 'numba'
+    return _rasterize_numpy(triangles, origin_x[0], dx, nx, origin_y[0], dy, ny), 'numpy'
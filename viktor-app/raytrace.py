@@ -1,3 +1,7 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from pathlib import Path
 
@@ -5,19 +9,62 @@ import numpy as np
 import PIL.Image
 
 import trimesh
+from trimesh.ray import ray_triangle
 from viktor import File
 
+from height_map_utils import height_map_to_image, make_height_map
+from rasterize import rasterize_top_z
+
+try:
+    # Embree bindings (embreex / pyembree) are optional, but give an order of magnitude faster ray queries
+    from trimesh.ray import ray_pyembree
+except ImportError:
+    ray_pyembree = None
+
+RAY_BACKENDS = ('auto', 'embree', 'triangle')
+METHODS = ('ray', 'raster', 'adaptive')
+
+# rough peak memory per ray while tracing: origins, vectors, hits and the intersector's intermediate arrays
+BYTES_PER_RAY = 512
+
+# parsed meshes by content hash, so the same scene is only parsed once per process
+MESH_CACHE_SIZE = 8
+_mesh_cache = OrderedDict()
+_mesh_cache_lock = threading.Lock()
+
+
+def _load_cached(data: bytes, file_type: str) -> trimesh.Trimesh:
+    """Parses the mesh, or returns the already parsed mesh of identical content. Keeps at most MESH_CACHE_SIZE meshes"""
+    key = (hashlib.sha256(data).hexdigest(), file_type)
+    with _mesh_cache_lock:
+        if key in _mesh_cache:
+            _mesh_cache.move_to_end(key)
+            return _mesh_cache[key]
+
+    mesh = trimesh.load(BytesIO(data), file_type=file_type, force='mesh')
+
+    with _mesh_cache_lock:
+        _mesh_cache[key] = mesh
+        _mesh_cache.move_to_end(key)
+        while len(_mesh_cache) > MESH_CACHE_SIZE:
+            _mesh_cache.popitem(last=False)
+    return mesh
+
+
+def clear_mesh_cache():
+    with _mesh_cache_lock:
+        _mesh_cache.clear()
+
 
 def get_trimesh_object(gltf_file: File = None, glb: File = None, test=False):
+    """Loads the geometry as a single mesh. Files are parsed once, later calls with the same content use the cache"""
     if test:
-        gltf = Path(__file__).parent / 'files' / 'geometry.stl'
-        file_type = 'stl'
+        gltf = Path(__file__).parent / 'files' / 'surroundings.glb'
+        file_type = 'glb'
     elif gltf_file:
-        gltf = BytesIO(gltf_file.getvalue_binary())
-        file_type = 'gltf'
+        return _load_cached(gltf_file.getvalue_binary(), 'gltf')
     elif glb:
-        gltf = BytesIO(glb.getvalue_binary())
-        file_type = 'glb'
+        return _load_cached(glb.getvalue_binary(), 'glb')
     else:
         # test on a simple mesh
         gltf = Path(__file__).parent / 'files' / 'surroundings.gltf'
@@ -25,65 +72,286 @@ def get_trimesh_object(gltf_file: File = None, glb: File = None, test=False):
     return trimesh.load(gltf, file_type=file_type, force='mesh')
 
 
-def gltf_raytrace(gltf_file: File = None, glb: File = None, return_image=False, test=False, discretization_value=1.5, bounding_box=None):
-    mesh = get_trimesh_object(gltf_file, glb, test)
+def get_ray_intersector(mesh, backend='auto'):
+    """Returns a ray intersector for the mesh and the name of the backend that is used.
+
+    backend='auto' picks Embree when it is installed and falls back to trimesh's own triangle intersector otherwise.
+    """
+    if backend not in RAY_BACKENDS:
+        raise ValueError(f"Unknown ray backend '{backend}', choose from {RAY_BACKENDS}")
+    if backend == 'embree' and ray_pyembree is None:
+        raise ImportError("Ray backend 'embree' requested, but no Embree bindings (embreex / pyembree) are installed")
+    if backend in ('auto', 'embree') and ray_pyembree is not None:
+        return ray_pyembree.RayMeshIntersector(mesh), 'embree'
+    return ray_triangle.RayMeshIntersector(mesh), 'triangle'
 
-    # scene will have automatically generated camera and lights
-    scene = mesh.scene()
-    if bounding_box is not None:
-        min, max = bounding_box
+
+def grid_axes(bounds_min, bounds_max, resolution):
+    """x and y coordinates of the pixel centres of a height map spanning the bounding box"""
+    return (np.linspace(bounds_min[0], bounds_max[0], resolution[0]),
+            np.linspace(bounds_min[1], bounds_max[1], resolution[1]))
+
+
+def _grid_spacing(origin_x, origin_y):
+    """Pixel size of the grid, which is close to but not exactly the discretization value"""
+    return tuple((axis[-1] - axis[0]) / (len(axis) - 1) if len(axis) > 1 else 0.0 for axis in (origin_x, origin_y))
+
+
+def orthographic_rays(bounds_min, bounds_max, resolution, z):
+    """Top-down rays on a regular grid spanning the bounding box.
+
+    Returns origins and vectors with one ray per pixel, and the (x, y) pixel index of every ray.
+    """
+    origin_x, origin_y = grid_axes(bounds_min, bounds_max, resolution)
+
+    pixels = np.stack(
+        np.meshgrid(np.arange(resolution[0]), np.arange(resolution[1]), indexing='ij'), axis=-1
+    ).reshape(-1, 2)
+
+    origins = np.empty((len(pixels), 3))
+    origins[:, 0] = origin_x[pixels[:, 0]]
+    origins[:, 1] = origin_y[pixels[:, 1]]
+    origins[:, 2] = z
+    vectors = np.zeros_like(origins)
+    vectors[:, 2] = -1
+    return origins, vectors, pixels
+
+
+def footprint_axes(mesh, grid):
+    """x and y coordinates of the pixels of the grid that the xy bounding box of the mesh covers.
+
+    grid is a dict with the origin, resolution and shape of a height map, see height_map_utils.height_map_grid.
+    """
+    (x_min, y_min, _), (x_max, y_max, _) = mesh.bounds
+    axes = []
+    for axis, (low, high) in enumerate([(x_min, x_max), (y_min, y_max)]):
+        origin, step, n = grid["origin"][axis], grid["resolution"][axis], grid["shape"][axis]
+        first = int(np.clip(np.floor((low - origin) / step), 0, n))
+        last = int(np.clip(np.ceil((high - origin) / step) + 1, 0, n))
+        axes.append(origin + np.arange(first, last) * step)
+    return axes
+
+
+def _cast_down(intersector, x, y, z):
+    """Elevation of the first hit of vertical rays from (x, y, z) downwards, and whether anything was hit"""
+    origins = np.column_stack([x, y, np.full(len(x), z)])
+    vectors = np.zeros_like(origins)
+    vectors[:, 2] = -1
+    points, index_ray, index_tri = intersector.intersects_location(
+        ray_origins=origins, ray_directions=vectors, multiple_hits=False
+    )
+    elevation = np.zeros(len(x))
+    hit = np.zeros(len(x), dtype=bool)
+    elevation[index_ray] = points[:, 2]
+    hit[index_ray] = True
+    return elevation, hit
+
+
+def _coarse_indices(n, step):
+    """Every step-th index of an axis of n pixels, always including the last one"""
+    indices = np.arange(0, n, step)
+    if indices[-1] != n - 1:
+        indices = np.append(indices, n - 1)
+    return indices
+
+
+def _adaptive_height_map(intersector, origin_x, origin_y, z, coarse_factor, tolerance):
+    """Traces a coarse grid first and re-traces at full resolution only the cells where the height varies.
+
+    A cell of the coarse grid is re-traced when the elevation of its corners differs more than tolerance, when only
+    some of its corners hit geometry, or when a neighbouring cell is re-traced. Other cells are interpolated
+    bilinearly from their corners. Features that fit in between the corners of a cell are missed, so coarse_factor
+    times the discretization value should stay below the smallest building that matters.
+    Returns the elevation, the nodata mask and the number of rays that were cast.
+    """
+    ci = _coarse_indices(len(origin_x), coarse_factor)
+    cj = _coarse_indices(len(origin_y), coarse_factor)
+    if len(ci) < 2 or len(cj) < 2:
+        coarse_factor = 1
+        ci, cj = np.arange(len(origin_x)), np.arange(len(origin_y))
+    gx, gy = np.meshgrid(origin_x[ci], origin_y[cj], indexing='ij')
+    coarse, coarse_hit = _cast_down(intersector, gx.ravel(), gy.ravel(), z)
+    coarse = coarse.reshape(gx.shape)
+    coarse_hit = coarse_hit.reshape(gx.shape)
+    rays = coarse.size
+
+    # corners of every coarse cell
+    corners = [coarse[:-1, :-1], coarse[1:, :-1], coarse[:-1, 1:], coarse[1:, 1:]]
+    corner_hits = [coarse_hit[:-1, :-1], coarse_hit[1:, :-1], coarse_hit[:-1, 1:], coarse_hit[1:, 1:]]
+    any_hit = np.logical_or.reduce(corner_hits)
+    all_hit = np.logical_and.reduce(corner_hits)
+    height_range = np.maximum.reduce(corners) - np.minimum.reduce(corners)
+    refine = (any_hit != all_hit) | (all_hit & (height_range > tolerance))
+    # also refine the neighbours, an edge running just past the corners of a cell is only seen by the next cell
+    padded = np.pad(refine, 1)
+    refine = np.logical_or.reduce([padded[1 + dx:padded.shape[0] - 1 + dx, 1 + dy:padded.shape[1] - 1 + dy]
+                                   for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+
+    # cell and position within the cell of every full resolution pixel
+    cell_x = np.clip(np.searchsorted(ci, np.arange(len(origin_x)), side='right') - 1, 0, len(ci) - 2)
+    cell_y = np.clip(np.searchsorted(cj, np.arange(len(origin_y)), side='right') - 1, 0, len(cj) - 2)
+    tx = ((np.arange(len(origin_x)) - ci[cell_x]) / (ci[cell_x + 1] - ci[cell_x]))[:, None]
+    ty = ((np.arange(len(origin_y)) - cj[cell_y]) / (cj[cell_y + 1] - cj[cell_y]))[None, :]
+    cx, cy = cell_x[:, None], cell_y[None, :]
+
+    elevation = (coarse[cx, cy] * (1 - tx) * (1 - ty) + coarse[cx + 1, cy] * tx * (1 - ty)
+                 + coarse[cx, cy + 1] * (1 - tx) * ty + coarse[cx + 1, cy + 1] * tx * ty)
+    mask = ~all_hit[cx, cy]
+
+    pixels = np.nonzero(refine[cx, cy])
+    if len(pixels[0]):
+        refined, refined_hit = _cast_down(intersector, origin_x[pixels[0]], origin_y[pixels[1]], z)
+        elevation[pixels] = refined
+        mask[pixels] = ~refined_hit
+        rays += len(refined)
+    elevation[mask] = 0
+    return elevation, mask, rays
+
+
+def _tiled_height_map(intersector, origin_x, origin_y, z, elevation, mask, memory_budget, workers):
+    """Traces the grid in square tiles that together stay roughly within memory_budget bytes, writing into elevation and
+    mask. The output arrays themselves are not part of the budget, pass memory-mapped arrays to keep them on disk.
+
+    workers tiles are traced at the same time, each with its own share of the budget. Returns the number of tiles.
+    """
+    tile_pixels = max(int(memory_budget / (BYTES_PER_RAY * workers)), 1)
+    tile_size = max(int(np.sqrt(tile_pixels)), 1)
+    tiles = [(x0, min(x0 + tile_size, len(origin_x)), y0, min(y0 + tile_size, len(origin_y)))
+             for x0 in range(0, len(origin_x), tile_size) for y0 in range(0, len(origin_y), tile_size)]
+
+    def trace(tile):
+        x0, x1, y0, y1 = tile
+        gx, gy = np.meshgrid(origin_x[x0:x1], origin_y[y0:y1], indexing='ij')
+        tile_elevation, tile_hit = _cast_down(intersector, gx.ravel(), gy.ravel(), z)
+        # tiles do not overlap, so they can be written concurrently
+        elevation[x0:x1, y0:y1] = tile_elevation.reshape(gx.shape)
+        mask[x0:x1, y0:y1] = ~tile_hit.reshape(gx.shape)
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(trace, tiles))
     else:
-        min, max = scene.bounding_box.bounds
-    resolution_x = int((max[0] - min[0]) / discretization_value)
-    resolution_y = int((max[1] - min[1]) / discretization_value)
+        for tile in tiles:
+            trace(tile)
+    return len(tiles)
+
 
-    [_, y_min, _] = min
-    [x_max, _, _] = max
+def gltf_raytrace(gltf_file: File = None, glb: File = None, return_image=False, test=False, discretization_value=1.5, bounding_box=None,
+                  backend='auto', method='ray', mesh: trimesh.Trimesh = None, coarse_factor=4, tolerance=0.25,
+                  memory_budget=None, workers=1, out_dir=None, footprint_grid=None):
+    """Top-down height map of the geometry.
+
+    method='ray' casts one vertical ray per pixel, method='raster' rasterizes the triangles into a z-buffer instead,
+    which is a lot faster for large meshes. method='adaptive' casts rays on a grid coarse_factor times coarser first
+    and only re-traces the cells where the height varies more than tolerance at full resolution, see
+    _adaptive_height_map. All return the same height map dict, see make_height_map.
+    With a memory_budget (in bytes), method='ray' traces the site in tiles that fit the budget, workers tiles at a
+    time. The other methods are not tiled and raise a ValueError with a memory_budget or workers. With out_dir, the
+    map is written to memory-mapped .npy files in that folder instead of kept in memory, the intermediate arrays of
+    'raster' and 'adaptive' are still full size.
+    With a footprint_grid (see height_map_utils.height_map_grid), only the part of that grid that the geometry covers
+    is traced, aligned to the pixels of the grid, e.g. to patch a single building into a site map.
+    An already loaded mesh can be passed instead of a file, to not parse the same geometry again.
+    The height map also has the backend that was used and the number of rays that were cast, None for 'raster'.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown method '{method}', choose from {METHODS}")
+    if (memory_budget is not None or workers != 1) and method != 'ray':
+        raise ValueError(f"memory_budget and workers only apply to method='ray', not to '{method}'")
+    if workers != 1 and memory_budget is None:
+        raise ValueError("workers trace tiles at the same time, give a memory_budget to trace in tiles")
+    if mesh is None:
+        mesh = get_trimesh_object(gltf_file, glb, test)
+
+    if footprint_grid is not None:
+        footprint_x, footprint_y = footprint_axes(mesh, footprint_grid)
+        if len(footprint_x) == 0 or len(footprint_y) == 0:  # completely outside of the grid
+            return make_height_map(np.zeros((0, 0), dtype=np.float32), np.ones((0, 0), dtype=bool),
+                                   footprint_grid["origin"], footprint_grid["resolution"], backend=None, rays=0)
+        min = [footprint_x[0], footprint_y[0], 0]
+        max = [footprint_x[-1], footprint_y[-1], 0]
+        resolution_x, resolution_y = len(footprint_x), len(footprint_y)
+    else:
+        if bounding_box is not None:
+            min, max = bounding_box
+        else:
+            min, max = mesh.bounds
+        resolution_x = int((max[0] - min[0]) / discretization_value)
+        resolution_y = int((max[1] - min[1]) / discretization_value)
 
-    # any of the automatically generated values can be overridden
     # set resolution, in pixels
     RESOLUTION = [resolution_x, resolution_y]
-    scene.camera.resolution = RESOLUTION
-    # set field of view, in degrees
-    # make it relative to resolution so pixels per degree is same
-    scene.camera.fov = 60 * (scene.camera.resolution / scene.camera.resolution.max())
-
-    # convert the camera to rays with one ray per pixel
-    origin_x = np.linspace(min[0], max[0], RESOLUTION[0])
-    origin_y = np.linspace(min[1], max[1], RESOLUTION[1])
-    origins, vectors, pixels = scene.camera_rays()
-
-    for idx, pixel in enumerate(pixels):
-        origins[idx] = np.array([origin_x[pixel[0]], origin_y[pixel[1]], origins[idx][2]])
-        vectors[idx] = np.array([0, 0, -1])
-
-    # do the actual ray- mesh queries
-    points, index_ray, index_tri = mesh.ray.intersects_location(
-        ray_origins=origins, ray_directions=vectors, multiple_hits=False
-    )
+    origin_x, origin_y = grid_axes(min, max, RESOLUTION)
 
-    # for each hit, find the distance along its vector
-    depth = trimesh.util.diagonal_dot(points - origins[0], vectors[index_ray])
-    # find pixel locations of actual hits
-    pixel_ray = pixels[index_ray]
+    # absolute elevation of the top-most surface per pixel, 0 and masked where nothing is hit
+    if out_dir is not None:
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        elevation = np.lib.format.open_memmap(out_dir / 'map.npy', mode='w+', dtype=np.float32, shape=tuple(RESOLUTION))
+        mask = np.lib.format.open_memmap(out_dir / 'mask.npy', mode='w+', dtype=bool, shape=tuple(RESOLUTION))
+        mask[:] = True
+    else:
+        elevation = np.zeros(RESOLUTION, dtype=np.float32)
+        mask = np.ones(RESOLUTION, dtype=bool)
+
+    rays = elevation.size  # one per pixel, unless traced adaptively
+    if method == 'raster':
+        rays = None
+        zbuffer, backend_name = rasterize_top_z(mesh, origin_x, origin_y)
+        hit = np.isfinite(zbuffer)
+        elevation[hit] = zbuffer[hit]
+        mask[hit] = False
+    elif method == 'adaptive':
+        intersector, backend_name = get_ray_intersector(mesh, backend)
+        elevation[:], mask[:], rays = _adaptive_height_map(
+            intersector, origin_x, origin_y, mesh.bounds[1][2] + 1, coarse_factor, tolerance
+        )
+    elif memory_budget is not None:
+        intersector, backend_name = get_ray_intersector(mesh, backend)
+        _tiled_height_map(intersector, origin_x, origin_y, mesh.bounds[1][2] + 1, elevation, mask, memory_budget,
+                          workers)
+    else:
+        intersector, backend_name = get_ray_intersector(mesh, backend)
+        # one vertical ray per pixel, starting just above the highest point of the mesh
+        origins, vectors, pixels = orthographic_rays(min, max, RESOLUTION, z=mesh.bounds[1][2] + 1)
 
-    # create a numpy array we can turn into an image
-    # doing it with uint8 creates an `L` mode greyscale image
-    a = np.zeros(scene.camera.resolution, dtype=np.uint8)
+        # do the actual ray- mesh queries
+        points, index_ray, index_tri = intersector.intersects_location(
+            ray_origins=origins, ray_directions=vectors, multiple_hits=False
+        )
 
-    # scale depth against range (0.0 - 1.0)
-    depth_float = (depth - depth.min()) / depth.ptp()
+        # find pixel locations of actual hits
+        pixel_ray = pixels[index_ray]
+        elevation[pixel_ray[:, 0], pixel_ray[:, 1]] = points[:, 2]
+        mask[pixel_ray[:, 0], pixel_ray[:, 1]] = False
 
-    # convert depth into 0 - 255 uint8
-    depth_int = (depth_float * 255).round().astype(np.uint8)
-    # assign depth to correct pixel locations
-    a[pixel_ray[:, 0], pixel_ray[:, 1]] = depth_int
-    # create a PIL image from the depth queries
+    height_map = make_height_map(
+        elevation, mask, origin=(origin_x[0], origin_y[0]), resolution=_grid_spacing(origin_x, origin_y),
+        backend=backend_name, rays=rays,
+    )
+    # create a PIL image from the height map, doing it with uint8 creates an `L` mode greyscale image
     if return_image:
-        return PIL.Image.fromarray(a)
-    return {"x": x_max, "y": y_min, "map": a}
+        return PIL.Image.fromarray(height_map_to_image(height_map))
+    return height_map
+
+
+def compare_height_maps(reference, other):
+    """Accuracy of a height map compared to a reference height map of the same grid, e.g. raster vs ray-cast"""
+    if reference["map"].shape != other["map"].shape:
+        raise ValueError(f"Height maps have different shapes: {reference['map'].shape} and {other['map'].shape}")
+    both = ~reference["mask"] & ~other["mask"]
+    difference = np.abs(reference["map"][both].astype(np.float64) - other["map"][both])
+    return {
+        "max_abs_difference": float(difference.max()) if difference.size else 0.0,
+        "mean_abs_difference": float(difference.mean()) if difference.size else 0.0,
+        "fraction_different": float(np.count_nonzero(difference > 1e-3) / reference["map"].size),
+        "fraction_coverage_different": float(np.count_nonzero(reference["mask"] != other["mask"]) / reference["map"].size),
+    }
 
 
 if __name__ == '__main__':
     pil_image = gltf_raytrace(return_image=True, test=True)
     pil_image.save('test-image.png', format='png')
+    print(compare_height_maps(gltf_raytrace(test=True), gltf_raytrace(test=True, method='raster')))
+    adaptive_height_map = gltf_raytrace(test=True, method='adaptive')
+    print(f"Adaptive ray-tracing: {adaptive_height_map['rays']} rays instead of {adaptive_height_map['map'].size}")
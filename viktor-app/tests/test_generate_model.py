@@ -0,0 +1,66 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import generate_model
+from disk_cache import DiskCache
+
+WIDTH_PARAMETER = "3d6526a1-9cac-4f4e-afa1-49661f2eba6a"
+
+
+class _ShapeDiverMock:
+    """ShapeDiver backend that answers output requests of wider models sooner, so they finish out of order"""
+
+    def __init__(self):
+        self.opened = 0
+        self.closed = 0
+        self.outputs = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        if request.method == "POST" and path.startswith("/api/v2/ticket/"):
+            self.opened += 1
+            return httpx.Response(201, json={"sessionId": "session"})
+        if request.method == "PUT" and path == "/api/v2/session/session/output":
+            self.outputs += 1
+            width = json.loads(request.content)[WIDTH_PARAMETER]
+            await asyncio.sleep(0.01 / width)
+            content = [{"contentType": "model/gltf-binary", "href": f"https://cdn.example.com/{width}.glb"}]
+            return httpx.Response(200, json={"outputs": {"output": {"content": content}}})
+        if request.method == "POST" and path == "/api/v2/session/session/close":
+            self.closed += 1
+            return httpx.Response(200)
+        if request.url.host == "cdn.example.com":
+            return httpx.Response(200, content=f"glb of {path.strip('/')}".encode())
+        return httpx.Response(404)
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    monkeypatch.setattr(generate_model, "geometry_cache", DiskCache("geometry", max_bytes=2 ** 20, root=tmp_path))
+    return _ShapeDiverMock()
+
+
+def _generate(dimensions, backend):
+    return asyncio.run(generate_model.generate_models_async(dimensions, transport=httpx.MockTransport(backend)))
+
+
+def test_models_are_generated_in_one_session_in_order(backend):
+    dimensions = [(width, 20, 30) for width in (1, 2, 3, 4, 5)]
+
+    models = _generate(dimensions, backend)
+
+    assert models == [f"glb of {width}.glb".encode() for width, _, _ in dimensions]
+    assert (backend.opened, backend.outputs, backend.closed) == (1, 5, 1)
+
+
+def test_no_session_is_opened_when_all_models_are_cached(backend):
+    dimensions = [(1, 20, 30), (2, 20, 30)]
+    _generate(dimensions, backend)
+
+    models = _generate(dimensions, backend)
+
+    assert models == [b"glb of 1.glb", b"glb of 2.glb"]
+    assert (backend.opened, backend.outputs, backend.closed) == (1, 2, 1)
@@ -0,0 +1,56 @@
+import random
+import threading
+import time
+
+import pytest
+
+from pipeline import Pipeline
+
+
+def _sleep_randomly(value):
+    time.sleep(random.uniform(0, 0.005))
+    return value
+
+
+def test_results_are_in_the_order_of_the_items():
+    pipeline = Pipeline([
+        ("double", lambda value: _sleep_randomly(value * 2), 4),
+        ("increment", lambda value: _sleep_randomly(value + 1), 3),
+    ])
+
+    assert pipeline.run(range(50)) == [value * 2 + 1 for value in range(50)]
+    assert pipeline.stats()["double"]["processed"] == 50
+    assert pipeline.stats()["increment"]["processed"] == 50
+
+
+def test_first_error_is_raised_after_all_items_are_through():
+    processed = []
+    lock = threading.Lock()
+
+    def fail_on_odd(value):
+        if value % 2:
+            raise ValueError(f"odd {value}")
+        return value
+
+    def record(value):
+        with lock:
+            processed.append(value)
+        return value
+
+    pipeline = Pipeline([("fail", fail_on_odd), ("record", record)], workers=2)
+
+    with pytest.raises(ValueError, match="odd 1"):
+        pipeline.run(range(10))
+    # later stages skip the failed items, but keep processing the others
+    assert sorted(processed) == [0, 2, 4, 6, 8]
+
+
+def test_progress_is_reported_until_all_items_are_finished():
+    reports = []
+    pipeline = Pipeline([("sleep", _sleep_randomly)])
+
+    pipeline.run(range(5), on_progress=lambda number_finished, stats: reports.append(number_finished),
+                 progress_interval=0.001)
+
+    assert reports[-1] == 5
+    assert reports == sorted(reports)
@@ -0,0 +1,118 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import trimesh
+from viktor import File
+
+import rasterize
+from generate_model import box_extents
+from generate_model import generate_box_model
+from height_map_utils import box_height_map
+from height_map_utils import crop_map
+from height_map_utils import height_map_grid
+from height_map_utils import materialize_map
+from height_map_utils import merge_maps
+from height_map_utils import patch_map
+from raytrace import compare_height_maps
+from raytrace import gltf_raytrace
+from raytrace import grid_axes
+
+SURROUNDINGS = Path(__file__).parent.parent / "files" / "surroundings.glb"
+
+
+@pytest.fixture(scope="module")
+def surroundings():
+    return trimesh.load(SURROUNDINGS, file_type="glb", force="mesh")
+
+
+@pytest.fixture(scope="module")
+def surroundings_height_map(surroundings):
+    return gltf_raytrace(mesh=surroundings, discretization_value=3)
+
+
+@pytest.mark.parametrize("use_numba", [False, pytest.param(True, marks=pytest.mark.skipif(
+    rasterize.numba is None, reason="numba is not installed"))])
+def test_raster_matches_ray_casting(surroundings, surroundings_height_map, monkeypatch, use_numba):
+    if not use_numba:
+        monkeypatch.setattr(rasterize, "numba", None)
+
+    raster = gltf_raytrace(mesh=surroundings, discretization_value=3, method="raster")
+
+    assert raster["backend"] == ("numba" if use_numba else "numpy")
+    accuracy = compare_height_maps(surroundings_height_map, raster)
+    assert accuracy["fraction_coverage_different"] < 1e-3
+    assert accuracy["max_abs_difference"] < 1e-3
+    np.testing.assert_array_equal(raster["map"][raster["mask"]], 0)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+@pytest.mark.parametrize("memory_mapped", [False, True])
+def test_tiled_ray_casting_matches_untiled(surroundings, surroundings_height_map, tmp_path, workers, memory_mapped):
+    tiled = gltf_raytrace(mesh=surroundings, discretization_value=3, memory_budget=200_000, workers=workers,
+                          out_dir=tmp_path if memory_mapped else None)
+
+    np.testing.assert_array_equal(tiled["map"], surroundings_height_map["map"])
+    np.testing.assert_array_equal(tiled["mask"], surroundings_height_map["mask"])
+    if memory_mapped:
+        np.testing.assert_array_equal(np.load(tmp_path / "map.npy"), surroundings_height_map["map"])
+
+
+@pytest.mark.parametrize("method", ["raster", "adaptive"])
+def test_memory_budget_is_only_for_ray_casting(surroundings, method):
+    with pytest.raises(ValueError):
+        gltf_raytrace(mesh=surroundings, method=method, memory_budget=200_000)
+
+
+@pytest.mark.parametrize("translation", [(0, 0), (12.3, -47.9), (-300.1, 250.6)])
+def test_footprint_patch_matches_full_site_trace(surroundings, surroundings_height_map, translation):
+    building = trimesh.creation.cylinder(radius=17.3, height=80, sections=7)
+    building.apply_translation([*translation, 40])
+    site_bounds = surroundings.bounds
+
+    full_site = merge_maps(surroundings_height_map,
+                           gltf_raytrace(mesh=building, discretization_value=3, bounding_box=site_bounds))
+    footprint = gltf_raytrace(mesh=building, footprint_grid=height_map_grid(surroundings_height_map))
+    patched = patch_map(surroundings_height_map, footprint)
+
+    assert footprint["map"].size < surroundings_height_map["map"].size / 100
+    np.testing.assert_array_equal(materialize_map(patched)["map"], full_site["map"])
+    np.testing.assert_array_equal(materialize_map(patched)["mask"], full_site["mask"])
+    np.testing.assert_array_equal(crop_map(patched, size=100)["map"], crop_map(full_site, size=100)["map"])
+
+
+@pytest.mark.parametrize("dimensions", [(30, 30, 100), (31.7, 12.2, 45.5), (3, 3, 10)])
+def test_box_height_map_matches_ray_tracing_the_box_model(surroundings_height_map, dimensions):
+    grid = height_map_grid(surroundings_height_map)
+
+    box = box_height_map(grid, *box_extents(*dimensions))
+    traced = gltf_raytrace(glb=File.from_data(generate_box_model(*dimensions)), footprint_grid=grid)
+
+    # the traced footprint has a margin of uncovered pixels, which does not change the merged map
+    box_site = materialize_map(patch_map(surroundings_height_map, box))
+    traced_site = materialize_map(patch_map(surroundings_height_map, traced))
+    assert np.count_nonzero(~box["mask"]) == np.count_nonzero(~traced["mask"]) > 0
+    np.testing.assert_array_equal(box_site["map"], traced_site["map"])
+    np.testing.assert_array_equal(box_site["mask"], traced_site["mask"])
+
+
+def _camera_ray_elevation(mesh, resolution):
+    """Elevation per pixel with the rays of the original implementation: trimesh camera rays moved onto the grid"""
+    scene = mesh.scene()
+    scene.camera.resolution = resolution
+    scene.camera.fov = 60 * (scene.camera.resolution / scene.camera.resolution.max())
+    origin_x, origin_y = grid_axes(*mesh.bounds, resolution)
+    origins, vectors, pixels = scene.camera_rays()
+    for index, pixel in enumerate(pixels):
+        origins[index] = np.array([origin_x[pixel[0]], origin_y[pixel[1]], origins[index][2]])
+        vectors[index] = np.array([0, 0, -1])
+    points, index_ray, _ = mesh.ray.intersects_location(origins, vectors, multiple_hits=False)
+    elevation = np.zeros(resolution, dtype=np.float32)
+    elevation[pixels[index_ray, 0], pixels[index_ray, 1]] = points[:, 2]
+    return elevation
+
+
+def test_orthographic_rays_give_the_same_height_map_as_camera_rays(surroundings):
+    height_map = gltf_raytrace(mesh=surroundings, discretization_value=10, backend="triangle")
+
+    np.testing.assert_array_equal(height_map["map"], _camera_ray_elevation(surroundings, height_map["map"].shape))
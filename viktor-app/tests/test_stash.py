@@ -0,0 +1,103 @@
+import pytest
+
+import stash
+from stash import IdMappingJournal
+from stash import StashWriter
+from stash import count_stash_entities
+from stash import read_records
+from stash import read_stash
+
+requires_zstandard = pytest.mark.skipif(stash.zstandard is None, reason="zstandard is not installed")
+SUFFIXES = [".jsonl", ".jsonl.gz", pytest.param(".jsonl.zst", marks=requires_zstandard)]
+
+# parent id -> children, 1 and 2 are the root entities
+TREE = {None: [1, 2], 1: [3, 4], 2: [5], 3: [6, 7], 4: [], 5: [8], 6: [], 7: [], 8: []}
+
+
+def _entity(entity_id):
+    return {"id": entity_id, "entity_type": 1, "name": f"entity {entity_id}", "properties": {}}
+
+
+def _crawl(path, interrupt_after=None):
+    """Stashes TREE like ViktorSubDomain._download_database_jsonl, raising after interrupt_after batches"""
+    with StashWriter(path) as writer:
+        if writer.finished:
+            return
+        if not writer.has_header:
+            writer.write_header([{"id": 1, "name": "Entity"}])
+        if not writer.roots_done:
+            writer.write_children(None, [_entity(entity_id) for entity_id in TREE[None]])
+            writer.pending_ids = list(TREE[None])
+        batches = 0
+        level = writer.pending_ids
+        while level:
+            next_level = []
+            for parent_id in level:
+                if batches == interrupt_after:
+                    raise KeyboardInterrupt
+                writer.write_children(parent_id, [_entity(child_id) for child_id in TREE[parent_id]])
+                batches += 1
+                next_level.extend(TREE[parent_id])
+            level = next_level
+        writer.write_end()
+
+
+@pytest.mark.parametrize("suffix", SUFFIXES)
+@pytest.mark.parametrize("torn_bytes", [0, 5])
+def test_interrupted_stash_resumes_to_the_same_records(tmp_path, suffix, torn_bytes):
+    _crawl(tmp_path / f"complete{suffix}")
+    interrupted_path = tmp_path / f"interrupted{suffix}"
+    with pytest.raises(KeyboardInterrupt):
+        _crawl(interrupted_path, interrupt_after=3)
+    if torn_bytes:  # the last write was cut off halfway
+        content = interrupted_path.read_bytes()
+        interrupted_path.write_bytes(content[:-torn_bytes])
+
+    _crawl(interrupted_path)
+
+    assert list(read_records(interrupted_path)) == list(read_records(tmp_path / f"complete{suffix}"))
+
+
+@pytest.mark.parametrize("suffix", SUFFIXES)
+def test_read_stash(tmp_path, suffix):
+    path = tmp_path / f"stash{suffix}"
+    _crawl(path)
+
+    entity_types, root_entities, entities = read_stash(path)
+
+    assert entity_types == [{"id": 1, "name": "Entity"}]
+    assert [entity["id"] for entity in root_entities] == [1, 2]
+    assert sorted((parent_id, entity["id"]) for parent_id, entity in entities) == sorted(
+        (parent_id, child_id) for parent_id, children in TREE.items() if parent_id for child_id in children
+    )
+    assert count_stash_entities(path) == 6
+
+
+def test_incomplete_stash_is_rejected(tmp_path):
+    path = tmp_path / "stash.jsonl"
+    with pytest.raises(KeyboardInterrupt):
+        _crawl(path, interrupt_after=3)
+
+    with pytest.raises(ValueError):
+        count_stash_entities(path)
+    with pytest.raises(ValueError):
+        list(read_stash(path)[2])
+
+
+def test_journal_is_loaded_again(tmp_path):
+    path = tmp_path / "stash.jsonl.progress.jsonl"
+    journal = IdMappingJournal(path)
+    journal.update({1: 101, 2: 102})
+    journal.mark("children_removed")
+    journal.close()
+    with open(path, "ab") as f:  # interrupted while writing
+        f.write(b'{"old": 3, "ne')
+
+    journal = IdMappingJournal(path)
+    journal[3] = 103
+    journal.close()
+
+    journal = IdMappingJournal(path)
+    journal.close()
+    assert journal == {1: 101, 2: 102, 3: 103}
+    assert journal.marks == {"children_removed"}
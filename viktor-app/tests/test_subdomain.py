@@ -0,0 +1,155 @@
+import itertools
+import threading
+
+import click
+import pytest
+
+from stash import IdMappingJournal
+from stash import StashWriter
+from subdomain import ViktorSubDomain
+
+
+class _ProgressBar:
+
+    def __init__(self):
+        self.count = 0
+
+    def update(self, n):
+        self.count += n
+
+
+class _FakeSubDomain(ViktorSubDomain):
+    """Destination sub-domain that records posted entities instead of sending them"""
+
+    def __init__(self):
+        self._progress_lock = threading.Lock()
+        self._progressbar = _ProgressBar()
+        self._new_ids = itertools.count(1001)
+        self.posted = {}  # new id -> (new parent id, name)
+
+    def _post_request(self, path, data):
+        parent_id = int(path.split("/")[2])
+        with self._progress_lock:
+            new_id = next(self._new_ids)
+            self.posted[new_id] = (parent_id, data["name"])
+        return {"id": new_id}
+
+
+def _entity(entity_id, entity_type=1):
+    return {"id": entity_id, "entity_type": entity_type, "name": f"entity {entity_id}", "properties": {}}
+
+
+# (old parent id, entity) in stash order, 1 is the root entity which already exists in the destination as 101
+ENTITIES = [
+    (1, _entity(2)),
+    (1, _entity(3, entity_type=9)),
+    (2, _entity(4)),
+    (3, _entity(5)),
+    (5, _entity(6)),
+    (4, _entity(7)),
+]
+ENTITY_TYPE_MAPPING = {1: 11}
+
+
+def _tree(sub_domain, parent_id=101):
+    """Names of the posted entities below the parent, as a nested dict"""
+    return {name: _tree(sub_domain, new_id) for new_id, (new_parent_id, name) in sub_domain.posted.items()
+            if new_parent_id == parent_id}
+
+
+def test_entities_of_unknown_entity_type_are_skipped_with_their_subtree():
+    sub_domain = _FakeSubDomain()
+    mapping = {1: 101}
+
+    sub_domain.post_entity_stream(iter(ENTITIES), ENTITY_TYPE_MAPPING, mapping, max_workers=4)
+
+    assert _tree(sub_domain) == {"entity 2": {"entity 4": {"entity 7": {}}}}
+    assert set(mapping) == {1, 2, 4, 7}
+
+
+def test_journal_skips_entities_that_were_posted_before(tmp_path):
+    journal_path = tmp_path / "stash.jsonl.progress.jsonl"
+    interrupted = _FakeSubDomain()
+    journal = IdMappingJournal(journal_path)
+    journal[1] = 101
+    interrupted.post_entity_stream(iter(ENTITIES[:3]), ENTITY_TYPE_MAPPING, journal, max_workers=1)
+    journal.close()
+
+    resumed = _FakeSubDomain()
+    resumed.posted = dict(interrupted.posted)
+    resumed._new_ids = itertools.count(2001)
+    journal = IdMappingJournal(journal_path)
+    resumed.post_entity_stream(iter(ENTITIES), ENTITY_TYPE_MAPPING, journal, max_workers=4)
+    journal.close()
+
+    assert len(resumed.posted) == len(interrupted.posted) + 1
+    assert _tree(resumed) == {"entity 2": {"entity 4": {"entity 7": {}}}}
+    reloaded_journal = IdMappingJournal(journal_path)
+    reloaded_journal.close()
+    assert reloaded_journal == {1: 101, 2: 1001, 4: 1002, 7: 2001}
+
+
+class _FakeDestination(_FakeSubDomain):
+    """Destination with a single root entity 101, for upload_database_from_local_folder"""
+
+    def __init__(self, workspace="/workspaces/1"):
+        super().__init__()
+        self.name = "destination"
+        self.host = "https://destination.viktor.ai/api"
+        self.workspace = workspace
+        self.deleted_children = []
+
+    def get_entity_types(self):
+        return [{"id": 11, "class_name": "Entity"}]
+
+    def get_root_entities(self):
+        return [{"id": 101, "entity_type_name": "Root"}]
+
+    def delete_children(self, entity_id):
+        self.deleted_children.append(entity_id)
+        self.posted.clear()
+
+    def update_entity(self, entity_id, properties, message=None):
+        pass
+
+    def get_entity(self, entity_id, recursive=False):
+        return {"id": entity_id, "entity_type": 11, "properties": {}}
+
+    def get_parametrization(self, entity_id):
+        return None
+
+
+def _write_stash(path):
+    with StashWriter(path) as stash:
+        stash.write_header([{"id": 1, "class_name": "Entity"}])
+        stash.write_children(None, [{"id": 1, "entity_type": 1, "entity_type_name": "Root", "name": "root",
+                                     "properties": {}}])
+        stash.write_children(1, [_entity(2), _entity(3)])
+        stash.write_children(2, [_entity(4)])
+        stash.write_end()
+
+
+def test_finished_checkpointed_upload_can_be_run_again(tmp_path):
+    _write_stash(tmp_path / "stash.jsonl")
+    destination = _FakeDestination()
+    destination.upload_database_from_local_folder(tmp_path, "stash.jsonl", checkpointed=True)
+    assert not (tmp_path / "stash.jsonl.progress.jsonl").exists()
+
+    destination.upload_database_from_local_folder(tmp_path, "stash.jsonl", checkpointed=True)
+
+    assert destination.deleted_children == [101, 101]
+    assert _tree(destination) == {"entity 2": {"entity 4": {}}, "entity 3": {}}
+
+
+def test_checkpointed_upload_is_not_resumed_to_another_destination(tmp_path):
+    _write_stash(tmp_path / "stash.jsonl")
+    journal = IdMappingJournal(tmp_path / "stash.jsonl.progress.jsonl")
+    journal.mark("destination:https://destination.viktor.ai/api/workspaces/2")
+    journal.mark("children_removed")
+    journal[1] = 101
+    journal.close()
+    destination = _FakeDestination(workspace="/workspaces/1")
+
+    with pytest.raises(click.ClickException):
+        destination.upload_database_from_local_folder(tmp_path, "stash.jsonl", checkpointed=True)
+    assert destination.deleted_children == []
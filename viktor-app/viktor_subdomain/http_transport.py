@@ -0,0 +1,165 @@
+"""This module contains the shared HTTP transport: pooled keep-alive sessions per host, with timeouts and retries"""
+import os
+import threading
+import time
+from typing import Dict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 10))
+MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", 3))
+BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", 0.5))
+DEFAULT_TIMEOUT = (10, 300)  # (connect, read) in seconds
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Methods of which a retry cannot have a different effect than the first attempt
+IDEMPOTENT_METHODS = Retry.DEFAULT_ALLOWED_METHODS
+
+
+class _TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default timeout to every request that does not set one"""
+
+    def __init__(self, *args, timeout=DEFAULT_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+class _HostStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "errors": self.errors,
+            "mean_seconds": self.total_seconds / self.requests if self.requests else 0.0,
+            "max_seconds": self.max_seconds,
+        }
+
+
+_sessions: Dict[tuple, requests.Session] = {}
+_stats: Dict[str, _HostStats] = {}
+_lock = threading.Lock()
+
+
+def _host(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def _retry(kind: str) -> Retry:
+    if kind == "idempotent":
+        return Retry(
+            total=MAX_RETRIES,
+            read=0,  # a request that timed out while reading may have been processed, do not send it again
+            backoff_factor=BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=IDEMPOTENT_METHODS,
+            respect_retry_after_header=True,
+            raise_on_status=False,  # return the last response, callers check the status code themselves
+        )
+    # A POST may have been processed when the server answers with a 5xx or the connection drops after sending it, e.g.
+    # creating an entity twice or using up a refresh token. Only retry when the request certainly was not processed:
+    # connection errors before sending and 429. A streamed body, of any method, can only be read once, so it is only
+    # retried on connection errors.
+    return Retry(
+        total=MAX_RETRIES,
+        read=0,
+        other=0,
+        status=0 if kind == "streamed" else MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=(429,),
+        allowed_methods=None,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+
+def _new_session(kind: str) -> requests.Session:
+    retry = _retry(kind)
+    adapter = _TimeoutHTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _session_kind(method: str, data=None) -> str:
+    if data is not None and not isinstance(data, (bytes, str, dict, list, tuple)):  # file object, generator, encoder
+        return "streamed"
+    if method.upper() in IDEMPOTENT_METHODS:
+        return "idempotent"
+    return "non_idempotent"
+
+
+def get_session(url: str, method: str = "GET", data=None) -> requests.Session:
+    """The keep-alive session of the host of the url, with the retries that are safe for the method and body"""
+    host = _host(url)
+    key = (host, _session_kind(method, data))
+    with _lock:
+        if key not in _sessions:
+            _sessions[key] = _new_session(key[1])
+        if host not in _stats:
+            _stats[host] = _HostStats()
+        return _sessions[key]
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    """Same as requests.request, but over the pooled session of the host, with retries and latency statistics
+
+    Idempotent methods are retried on connection errors and on RETRY_STATUS_CODES, other methods only when the server
+    certainly did not process the request.
+    """
+    session = get_session(url, method, kwargs.get("data"))
+    stats = _stats[_host(url)]
+    start = time.perf_counter()
+    try:
+        response = session.request(method, url, **kwargs)
+    except requests.RequestException:
+        with _lock:
+            stats.requests += 1
+            stats.errors += 1
+        raise
+    seconds = time.perf_counter() - start
+    retries = getattr(response.raw, "retries", None)
+    with _lock:
+        stats.requests += 1
+        stats.retries += len(retries.history) if retries is not None else 0
+        stats.total_seconds += seconds
+        stats.max_seconds = max(stats.max_seconds, seconds)
+    return response
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+def put(url: str, **kwargs) -> requests.Response:
+    return request("PUT", url, **kwargs)
+
+
+def delete(url: str, **kwargs) -> requests.Response:
+    return request("DELETE", url, **kwargs)
+
+
+def get_stats() -> Dict[str, dict]:
+    """Per host the number of requests, retries and errors, and the mean and max latency"""
+    with _lock:
+        return {host: stats.as_dict() for host, stats in _stats.items()}
@@ -0,0 +1,281 @@
+"""This module contains the JSON Lines database stash, which is written and read one entity at a time
+
+A stash is a sequence of records, one per line:
+ - {"kind": "header", "version": 1, "entity_types": [...]}
+ - {"kind": "entity", "parent_id": <id, or null for root entities>, "entity": {...}}, parents before their children
+ - {"kind": "children_done", "id": <id, or null for the root entities>}, after all children of a parent
+ - {"kind": "end"}, once the whole database is in the stash
+
+Stashes of which the filename ends with .gz or .zst are compressed with gzip or zstandard (optional dependency).
+"""
+import gzip
+import io
+import json
+import os
+import threading
+import zlib
+from pathlib import Path
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for .zst stashes
+    zstandard = None
+
+STASH_VERSION = 1
+
+
+def _compression(path: Path) -> Optional[str]:
+    if path.suffix == '.gz':
+        return 'gzip'
+    if path.suffix == '.zst':
+        if zstandard is None:
+            raise ImportError("Install zstandard to read or write .zst stashes")
+        return 'zstandard'
+    return None
+
+
+class _AppendFile:
+    """Binary file that records are appended to, compressed according to the suffix of the path"""
+
+    def __init__(self, path: Path):
+        self._compression = _compression(path)
+        self._raw = open(path, 'ab')
+        if self._compression == 'gzip':
+            self._writer = gzip.GzipFile(fileobj=self._raw, mode='ab')
+        elif self._compression == 'zstandard':
+            self._writer = zstandard.ZstdCompressor().stream_writer(self._raw, closefd=False)
+        else:
+            self._writer = self._raw
+
+    def write_records(self, records: List[dict]) -> None:
+        """Appends the records and makes sure they are on disk, and can be decompressed, before returning"""
+        self._writer.write(b''.join(json.dumps(record).encode() + b'\n' for record in records))
+        if self._compression == 'gzip':
+            self._writer.flush(zlib.Z_SYNC_FLUSH)
+        elif self._compression == 'zstandard':
+            self._writer.flush(zstandard.FLUSH_FRAME)
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+
+    def close(self) -> None:
+        if self._writer is not self._raw:
+            self._writer.close()
+        self._raw.close()
+
+
+def _open_for_reading(path: Path):
+    compression = _compression(path)
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    if compression == 'zstandard':
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+        return io.BufferedReader(reader)
+    return open(path, 'rb')
+
+
+def read_records(path: Path) -> Iterator[dict]:
+    """Yields the records of a stash one by one, up to a record that was only partially written"""
+    read_errors = (EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+    with _open_for_reading(Path(path)) as f:
+        try:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    return
+                yield json.loads(line)
+        except read_errors:  # compressed stash that was interrupted while writing
+            return
+
+
+def is_jsonl_stash(path: Path) -> bool:
+    """Whether the stash is a JSON Lines stash, as opposed to a single json document"""
+    try:
+        first_record = next(read_records(path), None)
+    except ValueError:
+        return False
+    return isinstance(first_record, dict) and first_record.get('kind') == 'header'
+
+
+def read_stash(path: Path) -> Tuple[List[dict], List[dict], Iterator[Tuple[int, dict]]]:
+    """Entity types, root entities and a generator of (parent_id, entity) of all other entities of a stash.
+
+    Only the entity types and root entities are read up front, the other entities are read as the generator is
+    consumed. The generator raises a ValueError at the end if the stash was not finished.
+    """
+    records = read_records(path)
+    header = next(records)
+    root_entities = []
+    for record in records:
+        if record['kind'] == 'entity':
+            root_entities.append(record['entity'])
+        elif record['kind'] == 'children_done':  # of the root entities, always the first batch
+            break
+
+    def entities():
+        for record in records:
+            if record['kind'] == 'entity':
+                yield record['parent_id'], record['entity']
+            elif record['kind'] == 'end':
+                return
+        raise ValueError(f"The stash {path} is incomplete, run the stash again to finish it")
+
+    return header['entity_types'], root_entities, entities()
+
+
+def count_stash_entities(path: Path) -> int:
+    """Number of entities in the stash other than the root entities.
+
+    Raises a ValueError if the stash was not finished, so an incomplete stash can be rejected before it is used.
+    """
+    number_of_entities, finished = 0, False
+    for record in read_records(path):
+        if record['kind'] == 'entity' and record['parent_id'] is not None:
+            number_of_entities += 1
+        elif record['kind'] == 'end':
+            finished = True
+    if not finished:
+        raise ValueError(f"The stash {path} is incomplete, run the stash again to finish it")
+    return number_of_entities
+
+
+class StashWriter:
+    """Appends entities to a stash, in batches of all children of one parent.
+
+    Every batch ends with the children_done record of its parent, which commits the batch. A stash that was
+    interrupted is cut off after its last committed batch when it is opened again, after which the crawl can continue
+    with the entities of which the children are not committed yet (pending_ids).
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.pending_ids: List[int] = []
+        self.has_header = False
+        self.roots_done = False
+        self.finished = False
+        if self.path.exists():
+            self._recover()
+        self._file = _AppendFile(self.path)
+
+    def _recover(self) -> None:
+        entity_ids, batch_ids, done_ids = [], [], set()
+        number_of_records = committed_records = 0
+        for record in read_records(self.path):
+            number_of_records += 1
+            if record['kind'] == 'entity':
+                batch_ids.append(record['entity']['id'])
+                continue
+            if record['kind'] == 'header':
+                self.has_header = True
+            elif record['kind'] == 'children_done':
+                entity_ids += batch_ids
+                batch_ids = []
+                done_ids.add(record['id'])
+            elif record['kind'] == 'end':
+                self.finished = True
+            committed_records = number_of_records
+        self._cut_off(committed_records)
+
+        self.roots_done = None in done_ids
+        self.pending_ids = [entity_id for entity_id in entity_ids if entity_id not in done_ids]
+
+    def _cut_off(self, number_of_records: int) -> None:
+        """Removes everything after the first number_of_records records"""
+        if _compression(self.path) is None:
+            with open(self.path, 'r+b') as f:
+                for _ in range(number_of_records):
+                    f.readline()
+                f.truncate()
+            return
+        # compressed streams cannot be truncated at a record, so the committed records are copied to a new file
+        temporary_path = self.path.with_name(f".{self.path.name}.tmp{self.path.suffix}")
+        temporary_path.unlink(missing_ok=True)
+        new_file = _AppendFile(temporary_path)
+        records = read_records(self.path)
+        batch = []
+        for _, record in zip(range(number_of_records), records):
+            batch.append(record)
+            if len(batch) == 1000:
+                new_file.write_records(batch)
+                batch = []
+        new_file.write_records(batch)
+        records.close()
+        new_file.close()
+        os.replace(temporary_path, self.path)
+
+    def write_header(self, entity_types: List[dict]) -> None:
+        self._file.write_records([{"kind": "header", "version": STASH_VERSION, "entity_types": entity_types}])
+        self.has_header = True
+
+    def write_children(self, parent_id: Optional[int], children: List[dict]) -> None:
+        """Commits all children of the parent, None for the root entities"""
+        records = [{"kind": "entity", "parent_id": parent_id, "entity": child} for child in children]
+        self._file.write_records(records + [{"kind": "children_done", "id": parent_id}])
+
+    def write_end(self) -> None:
+        self._file.write_records([{"kind": "end"}])
+        self.finished = True
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> 'StashWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class IdMappingJournal(dict):
+    """old_to_new_ids_mapping that appends every new mapping, and progress marks, to a JSON Lines journal.
+
+    When the journal already exists, the mappings and marks in it are loaded, so an interrupted restore can continue
+    where it stopped.
+    """
+
+    def __init__(self, path: Path):
+        super().__init__()
+        self.path = Path(path)
+        self.marks: Set[str] = set()
+        self._lock = threading.Lock()
+        if self.path.exists():
+            committed_size = 0
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):  # partially written line
+                        break
+                    record = json.loads(line)
+                    if 'mark' in record:
+                        self.marks.add(record['mark'])
+                    else:
+                        super().__setitem__(record['old'], record['new'])
+                    committed_size = f.tell()
+            with open(self.path, 'r+b') as f:
+                f.truncate(committed_size)
+        self._file = _AppendFile(self.path)
+
+    def __setitem__(self, old_id: int, new_id: int) -> None:
+        with self._lock:
+            self._file.write_records([{"old": old_id, "new": new_id}])
+            super().__setitem__(old_id, new_id)
+
+    def update(self, mapping: Dict[int, int] = (), **kwargs) -> None:
+        for old_id, new_id in dict(mapping, **kwargs).items():
+            self[old_id] = new_id
+
+    def mark(self, name: str) -> None:
+        with self._lock:
+            self._file.write_records([{"mark": name}])
+            self.marks.add(name)
+
+    def close(self) -> None:
+        self._file.close()
+
+    def remove(self) -> None:
+        """Closes and deletes the journal, e.g. once the upload it belongs to is finished"""
+        self.close()
+        self.path.unlink(missing_ok=True)
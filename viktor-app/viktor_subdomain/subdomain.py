@@ -1,9 +1,15 @@
 """This module contains a class representation and all related functions for a Viktor Sub-domain"""
+import hashlib
+import io
 import json
 import os
 import sys
+import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 from time import sleep
+from typing import BinaryIO
 from typing import Dict
 from typing import List
 from typing import Optional
@@ -12,15 +18,32 @@ from typing import TypedDict
 from typing import Union
 
 import click
-import requests
 
+try:
+    from requests_toolbelt import MultipartEncoder
+except ImportError:  # optional, without it the multipart upload is built in memory
+    MultipartEncoder = None
+
+import http_transport
 from helper_functions import add_field_names_referring_to_entities_to_container
 from helper_functions import update_id_on_entity_fields
 from helper_functions import validate_root_entities_compatibility
+from stash import IdMappingJournal
+from stash import StashWriter
+from stash import count_stash_entities
+from stash import is_jsonl_stash
+from stash import read_stash
 
 # ============================== Authentication related classes and constants ============================== #
 _STANDARD_HEADERS = {'Content-Type': "application/json"}
 CLIENT_ID = "e17LqAF9OGdZ4fVwHdDrpUEYQrWldqNVpvBdS1lb"
+# Number of concurrent requests when crawling an entity tree
+CRAWL_WORKERS = int(os.getenv("VIKTOR_CRAWL_WORKERS", 8))
+# Number of entities that are posted concurrently, including the transfer of their files
+POST_WORKERS = int(os.getenv("VIKTOR_POST_WORKERS", 8))
+# Files larger than this are spooled to a temporary file instead of kept in memory while they are transferred
+SPOOL_THRESHOLD = int(os.getenv("VIKTOR_SPOOL_THRESHOLD", 16 * 1024 ** 2))
+_CHUNK_SIZE = 1024 ** 2
 
 
 
@@ -78,14 +101,83 @@ def _get_element_count_of_tree(children: List[dict], size: int = 1) -> int:
     return size
 
 
+def _tree_node(entity: Dict) -> Dict:
+    """Node of an entity tree as returned by ViktorSubDomain.get_children(recursive=True), without its children yet"""
+    return {
+        'id': entity['id'],
+        'entity_type': entity['entity_type'],
+        'name': entity['name'],
+        'properties': entity['properties'],
+        'children': [],
+    }
+
+
 # ============================== S3 related functions ============================== #
 def get_file_content_from_s3(entity: EntityDict) -> Optional[bytes]:
     """If entity has a filename property, download the file_content from the temporary download url"""
     temp_download_url = entity['properties'].get('filename', None)
     if temp_download_url:
-        file_download = requests.get(temp_download_url)
+        file_download = http_transport.get(temp_download_url)
         return file_download.content
     return None
+
+
+def _md5_of_etag(etag: Optional[str]) -> Optional[str]:
+    """The md5 hex digest that S3 uses as ETag of objects that were not uploaded in parts, else None"""
+    etag = (etag or '').strip('"')
+    if len(etag) == 32 and '-' not in etag:
+        return etag.lower()
+    return None
+
+
+class _SizedReader:
+    """Read-only view of a file object with a len attribute, so MultipartEncoder does not need its fileno.
+
+    Asking a SpooledTemporaryFile for its fileno moves it to disk, also when it is small enough to stay in memory.
+    """
+
+    def __init__(self, file: BinaryIO):
+        self._file = file
+        position = file.tell()
+        self._end = file.seek(0, io.SEEK_END)
+        file.seek(position)
+
+    @property
+    def len(self) -> int:
+        return self._end - self._file.tell()
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+
+def open_file_from_s3(entity: EntityDict, verify_checksum: bool = False) -> Optional[BinaryIO]:
+    """Like get_file_content_from_s3, but streams the download into a file object instead of reading it into memory.
+
+    The file is kept in memory up to SPOOL_THRESHOLD bytes, and spooled to a temporary file above that. With
+    verify_checksum, the md5 of the download is compared to the ETag of S3, if that is an md5, and kept as the md5
+    attribute of the file. The caller closes the returned file.
+    """
+    temp_download_url = entity['properties'].get('filename', None)
+    if not temp_download_url:
+        return None
+    file = tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD)
+    md5 = hashlib.md5()
+    try:
+        with http_transport.get(temp_download_url, stream=True) as file_download:
+            file_download.raise_for_status()
+            for chunk in file_download.iter_content(chunk_size=_CHUNK_SIZE):
+                file.write(chunk)
+                md5.update(chunk)
+            expected_md5 = _md5_of_etag(file_download.headers.get('ETag'))
+        if verify_checksum and expected_md5 and expected_md5 != md5.hexdigest():
+            raise IOError(f"Checksum mismatch downloading the file of {entity['name']}")
+    except BaseException:
+        file.close()
+        raise
+    if verify_checksum:  # post_child checks the upload against it
+        file.md5 = md5.hexdigest()
+    file.seek(0)
+    return file
 # ================================================================================== #
 
 
@@ -150,12 +242,14 @@ class ViktorSubDomain:
             workspace: str = "1",
     ):
         print(f"Logging in to {sub_domain}")
+        self._token_lock = threading.Lock()
+        self._progress_lock = threading.Lock()  # progress bar and id mapping are updated from several threads
         self.name = sub_domain
         self.host = f"https://{sub_domain}.viktor.ai/api"
         self.client_id = client_id
         if not access_token:
             # Perform post request to '/o/token/' end-point to login
-            response = requests.post(f"{self.host}/o/token/", data=json.dumps(auth_details), headers=_STANDARD_HEADERS)
+            response = http_transport.post(f"{self.host}/o/token/", data=json.dumps(auth_details), headers=_STANDARD_HEADERS)
             if response.status_code != 200:
                 print(f"Provided credentials are not valid.\n{response.text}")
                 sys.exit(1)
@@ -203,7 +297,7 @@ class ViktorSubDomain:
         """Log out of the subdomain by revoking the access access_token"""
         if self._logged_in and self.client_id == CLIENT_ID:  # Do not logout SSO, since token already expires in 15 min.
             payload = dict(client_id=self.client_id, token=self.access_token)
-            response = requests.post(
+            response = http_transport.post(
                 f"{self.host}/o/revoke_token/", data=json.dumps(payload), headers=_STANDARD_HEADERS
             )
             if response.status_code == 200:
@@ -215,11 +309,20 @@ class ViktorSubDomain:
     def refresh_tokens(self) -> None:
         """Tokens for SSO expire within 900 seconds, so this function refreshes the tokens when it is expired"""
         payload = {"refresh_token": self.refresh_token, "client_id": self.client_id, "grant_type": "refresh_token"}
-        response = requests.post(f"{self.host}/o/token/", data=json.dumps(payload), headers=_STANDARD_HEADERS)
+        response = http_transport.post(f"{self.host}/o/token/", data=json.dumps(payload), headers=_STANDARD_HEADERS)
         response_json = response.json()
         self.access_token = response_json['access_token']
         self.refresh_token = response_json['refresh_token']
 
+    def _refresh_rejected_tokens(self, rejected_headers: dict) -> None:
+        """Refreshes the tokens after a request with rejected_headers got a 401.
+
+        When several threads get a 401 at the same time, only the first one refreshes, the others use the new token.
+        """
+        with self._token_lock:
+            if self.headers['Authorization'] == rejected_headers['Authorization']:
+                self.refresh_tokens()
+
     @classmethod
     def from_login(cls, sub_domain: str, username: str, password: str, workspace: str = "1") -> 'ViktorSubDomain':
         """Class method to login with sub-domain, username and password"""
@@ -236,16 +339,20 @@ class ViktorSubDomain:
         return {item['name'].lower(): int(item['id']) for item in sorted(workspaces_list, key=lambda p: p['id'])}
 
     # ============================== Basic GET and POST requests ============================== #
+    def _authenticated_request(self, method: str, url: str, **kwargs):
+        """Request with the current access token, which is refreshed once if it turns out to be expired"""
+        headers = self.headers
+        response = http_transport.request(method, url, headers=headers, **kwargs)
+        if response.status_code == 401:
+            self._refresh_rejected_tokens(headers)
+            response = http_transport.request(method, url, headers=self.headers, **kwargs)
+        return response
+
     def _get_request(self, path: str, exclude_workspace: bool = False) -> Union[dict, List[dict]]:
         """Simple get request using the subdomain authentication"""
         if not path.startswith('/'):
             raise SyntaxError('URL should start with a "/"')
-        response = requests.request("GET", f"{self.host}{'' if exclude_workspace else self.workspace}{path}",
-                                    headers=self.headers)
-        if response.status_code == 401:
-            self.refresh_tokens()
-            response = requests.request("GET", f"{self.host}{'' if exclude_workspace else self.workspace}{path}",
-                                        headers=self.headers)
+        response = self._authenticated_request("GET", f"{self.host}{'' if exclude_workspace else self.workspace}{path}")
         response.raise_for_status()
         return response.json()
 
@@ -253,14 +360,8 @@ class ViktorSubDomain:
         """Simple post request using the subdomain authentication"""
         if not path.startswith('/'):
             raise SyntaxError('URL should start with a "/"')
-        response = requests.request("POST", f"{self.host}{'' if exclude_workspace else self.workspace}{path}",
-                                    data=json.dumps(data),
-                                    headers=self.headers)
-        if response.status_code == 401:
-            self.refresh_tokens()
-            response = requests.request("POST", f"{self.host}{'' if exclude_workspace else self.workspace}{path}",
-                                        data=json.dumps(data),
-                                        headers=self.headers)
+        response = self._authenticated_request("POST", f"{self.host}{'' if exclude_workspace else self.workspace}{path}",
+                                               data=json.dumps(data))
         response.raise_for_status()
         if response.text:  # A DELETE request has no returned text, so check if there is text
             return response.json()
@@ -270,7 +371,7 @@ class ViktorSubDomain:
         """Simple put request using the subdomain authentication"""
         if not path.startswith('/'):
             raise SyntaxError('URL should start with a "/"')
-        response = requests.request(
+        response = http_transport.request(
             "PUT", f"{self.host}{self.workspace}{path}", data=json.dumps(data), headers=self.headers
         )
         response.raise_for_status()
@@ -280,7 +381,7 @@ class ViktorSubDomain:
         """Simple delete request"""
         if not path.startswith('/'):
             raise SyntaxError('URL should start with a "/"')
-        response = requests.request(
+        response = http_transport.request(
             "DELETE", f"{self.host}{self.workspace}{path}", headers=self.headers
         )
         response.raise_for_status()
@@ -327,6 +428,9 @@ class ViktorSubDomain:
         In addition to the standard get children function, for each file entity the filename-property is replaced with
         the temporary_download_url from S3. This will allow the file to be downloaded, should it be needed later on.
         """
+        if recursive:
+            return self.crawl_children([{'id': parent_id}])[0]['children']
+
         children = self._get_request(f"/entities/{parent_id}/entities/")
 
         if not children:
@@ -336,20 +440,48 @@ class ViktorSubDomain:
         for child in children:
             self._clean_up_entity(child)
 
-        if recursive:
-            return [
-                {
-                    'id': child['id'],
-                    'entity_type': child['entity_type'],
-                    'name': child['name'],
-                    'properties': child['properties'],
-                    'children': self.get_children(child['id'], recursive=recursive)
-                 }
-                for child in children
-            ]
-
         return children
 
+    def crawl_children(self, nodes: List[Dict], max_workers: int = CRAWL_WORKERS) -> List[Dict]:
+        """Fills in the children of the nodes, level by level, and returns the nodes.
+
+        The children of the nodes at the same depth are requested concurrently, followed by the temporary download urls
+        of the file entities among them, with at most max_workers requests at the same time. The resulting tree is the
+        same as that of walking the tree depth-first, one request at a time.
+        """
+        nodes_by_id = {node['id']: node for node in nodes}
+
+        def add_children(parent_id: int, children: List[Dict]) -> None:
+            nodes_by_id[parent_id]['children'] = [_tree_node(child) for child in children]
+            nodes_by_id.update((node['id'], node) for node in nodes_by_id[parent_id]['children'])
+
+        self._crawl(list(nodes_by_id), add_children, max_workers=max_workers)
+        return nodes
+
+    def _crawl(self, parent_ids: List[int], on_children, max_workers: int = CRAWL_WORKERS) -> None:
+        """Requests the children of the parents and of all their descendants level by level, see crawl_children.
+
+        on_children(parent_id, children) is called from the calling thread with the cleaned up children of every parent.
+        """
+        def get_level_children(entity_id: int) -> List[Dict]:
+            return self._get_request(f"/entities/{entity_id}/entities/") or []
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            level = parent_ids
+            while level:
+                next_level = []
+                # Only the children of a few parents at a time are kept in memory, the rest of the level are ids
+                for start in range(0, len(level), 4 * max_workers):
+                    parents = level[start:start + 4 * max_workers]
+                    children_per_parent = list(pool.map(get_level_children, parents))
+                    list(pool.map(self._clean_up_entity,
+                                  [child for children in children_per_parent for child in children]))
+
+                    for parent_id, children in zip(parents, children_per_parent):
+                        on_children(parent_id, children)
+                        next_level.extend(child['id'] for child in children)
+                level = next_level
+
     def get_entity_tree(self, parent_id: int = None, exclude_children: bool = False) -> EntityDict:
         """"Iterates through the entity database using a recursive function.
 
@@ -398,56 +530,155 @@ class ViktorSubDomain:
         """Get the parametrization of the current entity. In this parametrization the field types can be found"""
         return self._post_request(f"/entities/{entity_id}/parametrization/", {})
 
-    def upload_file(self, file_content: bytes, entity_type: int) -> str:
-        """Uploads a file to S3 using the host authentication and returns the filename url"""
+    def upload_file(self, file_content: Union[bytes, BinaryIO], entity_type: int, expected_md5: str = None) -> str:
+        """Uploads a file to S3 using the host authentication and returns the filename url
+
+        file_content can also be a file object, which is streamed to S3 if requests_toolbelt is installed. If an
+        expected_md5 is given, it is compared to the ETag that S3 returns for the upload.
+        """
         # Upload the file to S3
         result = self._post_request(f"/entity_types/{entity_type}/upload/", data={})
-        requests.post(result['url'], data=result['fields'], files={'file': file_content})
+        if MultipartEncoder is not None and not isinstance(file_content, bytes):
+            encoder = MultipartEncoder(fields={**result['fields'], 'file': ('file', _SizedReader(file_content))})
+            response = http_transport.post(result['url'], data=encoder, headers={'Content-Type': encoder.content_type})
+        else:
+            response = http_transport.post(result['url'], data=result['fields'], files={'file': file_content})
+        if expected_md5:
+            response.raise_for_status()
+            uploaded_md5 = _md5_of_etag(response.headers.get('ETag'))
+            if uploaded_md5 and uploaded_md5 != expected_md5:
+                raise IOError(f"Checksum mismatch uploading {result['fields']['key']}")
 
         # Return the filename url which should be add the the file entity
         return result['fields']['key']
 
-    def post_child(self, parent_id: int, entity_type: int, entity_dict: dict, file_content: bytes = None,
-                   dry_run: bool = False, old_to_new_ids_mapping: Optional[Dict] = None) -> EntityDict:
+    def post_child(self, parent_id: int, entity_type: int, entity_dict: dict,
+                   file_content: Union[bytes, BinaryIO] = None, dry_run: bool = False,
+                   old_to_new_ids_mapping: Optional[Dict] = None) -> EntityDict:
         """Replacement of the entity().post_child() method in the SDK
 
         Has additional option to include file_content, which creates the file entity and also uploads file_content to S3
 
+        file_content may also be a file object from open_file_from_s3, of which the upload is checked against its md5
+
         If an old_to_new_ids_mapping is given as dict, the dict is updated with a mapping of the children {old_id: new_id}
         """
         if dry_run:
             return {'id': 0}
 
         if file_content:
-            file_url = self.upload_file(file_content, entity_type)
+            file_url = self.upload_file(file_content, entity_type, expected_md5=getattr(file_content, 'md5', None))
             entity_dict["properties"].update({"filename": file_url})
 
         data = {"entity_type": entity_type, "name": entity_dict["name"], "properties": entity_dict["properties"]}
         response = self._post_request(f"/entities/{parent_id}/entities/", data)
-        self._progressbar.update(1)
-        if old_to_new_ids_mapping is not None:
-            old_to_new_ids_mapping[entity_dict["id"]] = response["id"]
+        with self._progress_lock:
+            self._progressbar.update(1)
+            if old_to_new_ids_mapping is not None:
+                old_to_new_ids_mapping[entity_dict["id"]] = response["id"]
 
         return response
 
+    def _transfer_child(self, parent_id: int, child: dict, entity_type_mapping: dict, dry_run: bool = False,
+                        old_to_new_ids_mapping: Optional[Dict] = None,
+                        verify_checksum: bool = False) -> Optional[EntityDict]:
+        """Streams the file of the child, if any, and posts the child with it. Returns None if it was skipped
+
+        A child that is already in old_to_new_ids_mapping, when resuming an interrupted upload, is not posted again.
+        """
+        if old_to_new_ids_mapping is not None and child['id'] in old_to_new_ids_mapping:
+            with self._progress_lock:
+                self._progressbar.update(1)
+            return {'id': old_to_new_ids_mapping[child['id']]}
+
+        file = None
+        try:
+            new_entity_type_id = entity_type_mapping[child['entity_type']]
+            file = open_file_from_s3(child, verify_checksum=verify_checksum)
+            return self.post_child(parent_id, new_entity_type_id, child, file_content=file, dry_run=dry_run,
+                                   old_to_new_ids_mapping=old_to_new_ids_mapping)
+        except KeyError:
+            print(f'Could not find entity type for {child["name"]}. Skipping entity and all its children.')
+            return None
+        finally:
+            if file is not None:
+                file.close()
+
     def post_children(self, parent_id: int, children: List[dict], entity_type_mapping: dict, dry_run: bool = False,
-                      recursive: bool = False, old_to_new_ids_mapping: Optional[Dict] = None) -> None:
-        """Creates the children under the top-level entity"""
-        for child in children:
-            try:
-                new_entity_type_id = entity_type_mapping[child['entity_type']]
-                created_child = self.post_child(parent_id, new_entity_type_id, child,
-                                                file_content=get_file_content_from_s3(child), dry_run=dry_run,
-                                                old_to_new_ids_mapping=old_to_new_ids_mapping)
-
-                if recursive:
-                    self.post_children(created_child['id'], child['children'], entity_type_mapping, dry_run=dry_run,
-                                       recursive=recursive, old_to_new_ids_mapping=old_to_new_ids_mapping)
-            except KeyError:
-                print(f'Could not find entity type for {child["name"]}. Skipping entity and all its children.')
+                      recursive: bool = False, old_to_new_ids_mapping: Optional[Dict] = None,
+                      max_workers: int = POST_WORKERS, verify_checksum: bool = False) -> None:
+        """Creates the children under the top-level entity
+
+        Siblings do not depend on each other, so every child is posted as soon as its parent exists, at most max_workers
+        at the same time. Each of them downloads its file, uploads it and posts the entity, so the transfers of different
+        entities overlap. Siblings are therefore not necessarily created in the given order. Files are streamed, see
+        open_file_from_s3, and with verify_checksum their download and upload are checked against their md5.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            def submit(new_parent_id, child):
+                future = pool.submit(self._transfer_child, new_parent_id, child, entity_type_mapping, dry_run=dry_run,
+                                     old_to_new_ids_mapping=old_to_new_ids_mapping, verify_checksum=verify_checksum)
+                pending[future] = child
+
+            pending = {}
+            for child in children:
+                submit(parent_id, child)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    child = pending.pop(future)
+                    try:
+                        created_child = future.result()
+                    except Exception:
+                        for other in pending:
+                            other.cancel()
+                        raise
+                    if recursive and created_child is not None:
+                        for grandchild in child['children']:
+                            submit(created_child['id'], grandchild)
+
+    def post_entity_stream(self, entities, entity_type_mapping: dict, old_to_new_ids_mapping: Dict,
+                           max_workers: int = POST_WORKERS, verify_checksum: bool = False) -> None:
+        """Posts (old parent_id, entity) pairs as they come, e.g. from stash.read_stash, in which parents come first.
+
+        The new id of the parent of every entity is looked up in old_to_new_ids_mapping, which is updated with every
+        posted entity. Entities are posted concurrently like in post_children, while at most 2 * max_workers entities
+        are read ahead, so memory use does not depend on the number of entities.
+        """
+        skipped_ids = set()  # Entities without a matching entity type, of which the children are skipped as well
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            pending = {}
+
+            def collect(keep_waiting):
+                """Collects finished posts while keep_waiting()"""
+                while pending and keep_waiting():
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        entity_id = pending.pop(future)
+                        try:
+                            created_entity = future.result()
+                        except Exception:
+                            for other in pending:
+                                other.cancel()
+                            raise
+                        if created_entity is None:
+                            skipped_ids.add(entity_id)
+
+            for parent_id, entity in entities:
+                # Wait until the parent is posted and there is room for another entity
+                collect(lambda: parent_id in pending.values() or len(pending) >= 2 * max_workers)
+                if parent_id in skipped_ids:
+                    skipped_ids.add(entity['id'])
+                    continue
+                future = pool.submit(self._transfer_child, old_to_new_ids_mapping[parent_id], entity,
+                                     entity_type_mapping, old_to_new_ids_mapping=old_to_new_ids_mapping,
+                                     verify_checksum=verify_checksum)
+                pending[future] = entity['id']
+            collect(lambda: True)
 
     def post_entity_tree(self, entity_tree: EntityDict, entity_type_mapping: dict,
-                         parent_id: int = None, dry_run: bool = False, old_to_new_ids_mapping: Optional[Dict] = None) -> None:
+                         parent_id: int = None, dry_run: bool = False, old_to_new_ids_mapping: Optional[Dict] = None,
+                         verify_checksum: bool = False) -> None:
         """Iterates through the entity tree using a recursive function. Prompts the user for the top level entity.
 
         If dry_run is set to True, the recursive functions doesn't post to destination, but prints to screen
@@ -468,17 +699,21 @@ class ViktorSubDomain:
         with click.progressbar(length=nr_entities, label=progressbar_label) as progressbar:
             self._progressbar = progressbar
             self.post_children(parent_id, children, entity_type_mapping, dry_run=dry_run, recursive=True,
-                               old_to_new_ids_mapping=old_to_new_ids_mapping)
+                               old_to_new_ids_mapping=old_to_new_ids_mapping, verify_checksum=verify_checksum)
 
     def copy_entity_tree_to(self, destination_domain: 'ViktorSubDomain', source_ids: Tuple[int] = None, destination_id: int = None,
-                            exclude_children: bool = False, dry_run: bool = False) -> None:
-        """Transfers the entity from current sub-domain to destination sub-domain"""
+                            exclude_children: bool = False, dry_run: bool = False,
+                            verify_checksum: bool = False) -> None:
+        """Transfers the entity from current sub-domain to destination sub-domain
+
+        Files are streamed from source to destination, with verify_checksum they are checked against their md5.
+        """
         entity_type_mapping = self.get_entity_type_mapping(destination_domain)
 
         for s_id in source_ids or [None]:
             entity_tree = self.get_entity_tree(parent_id=s_id, exclude_children=exclude_children)
             destination_domain.post_entity_tree(entity_tree, entity_type_mapping, parent_id=destination_id,
-                                                dry_run=dry_run)
+                                                dry_run=dry_run, verify_checksum=verify_checksum)
 
     def update_entity(self, entity_id: int, entity_properties: EntityDict, dry_run: bool = False,
                       message: str = None) -> dict:
@@ -526,8 +761,17 @@ class ViktorSubDomain:
                             with (entity_type_dir / f'{entity["id"]}.json').open(mode='w+') as fw:
                                 json.dump(entity, fw)
 
-    def download_database_to_local_folder(self, destination: str, filename: str):
-        """Transfers all entities from current sub-domain to destination location as a single json file"""
+    def download_database_to_local_folder(self, destination: str, filename: str, checkpointed: bool = False):
+        """Transfers all entities from current sub-domain to destination location as a single json file
+
+        If the filename has a .jsonl extension (optionally followed by .gz or .zst for compression) or checkpointed is
+        set, the entities are written to a JSON Lines stash one at a time while they are crawled instead, see stash.py.
+        An interrupted checkpointed stash continues where it stopped when it is run again.
+        """
+        if checkpointed or '.jsonl' in Path(filename).suffixes:
+            self._download_database_jsonl(Path(f'{destination}'), filename, resume=checkpointed)
+            return
+
         database_dict = {}  # Set up a dict which will be written to a file in the end
         all_entities = []  # Make a list in which all root entities including children will be saved
         # Todo also get the file content
@@ -545,52 +789,143 @@ class ViktorSubDomain:
             json.dump(database_dict, f)
         print(f"Stashed database in {destination_path}")
 
-    def upload_database_from_local_folder(self, source_folder: str, filename: str):
-        """Transfers all entities from current sub-domain to destination location as a single json file"""
-        with open(Path(f'{source_folder}') / filename, "r") as f:
-            database_dict = json.load(f)  # Get the database file
+    def _download_database_jsonl(self, destination_dir: Path, filename: str, resume: bool = False):
+        destination_dir.mkdir(parents=True, exist_ok=True)
+        destination_path = destination_dir / filename
+        if not resume:
+            destination_path.unlink(missing_ok=True)
+        with StashWriter(destination_path) as stash:
+            if stash.finished:
+                print(f"Stash in {destination_path} is already complete")
+                return
+            if stash.pending_ids or stash.roots_done:
+                print(f"Resuming stash in {destination_path}, {len(stash.pending_ids)} entities left to crawl")
+            if not stash.has_header:
+                stash.write_header(self.get_entity_types())
+            if not stash.roots_done:
+                root_entities = [self.get_entity(root_entity["id"]) for root_entity in self.get_root_entities()]
+                for root_entity in root_entities:
+                    del root_entity['children'], root_entity['size']  # Children are separate records
+                stash.write_children(None, root_entities)
+                stash.pending_ids = [root_entity["id"] for root_entity in root_entities]
+            self._crawl(stash.pending_ids, lambda parent_id, children: stash.write_children(
+                parent_id, [_tree_node(child) for child in children]
+            ))
+            stash.write_end()
+        print(f"Stashed database in {destination_path}")
+
+    def upload_database_from_local_folder(self, source_folder: str, filename: str, checkpointed: bool = False):
+        """Transfers all entities from current sub-domain to destination location as a single json file
+
+        Both stashes written as a single json file and JSON Lines stashes can be uploaded. JSON Lines stashes are read
+        and posted one entity at a time, so they do not have to fit in memory. An incomplete JSON Lines stash is
+        rejected before anything in the destination is changed. If checkpointed, the old to new id mapping and the
+        progress are recorded in a <filename>.progress.jsonl journal next to the stash. When an interrupted
+        checkpointed upload is run again, it continues after the last recorded entity instead of starting over.
+        Entities that were being posted at the moment of the interruption may end up in the destination twice. The
+        journal is removed once the upload is finished, and cannot be used to resume an upload to another sub-domain
+        or workspace.
+        """
+        source_path = Path(f'{source_folder}') / filename
+        source_entities = None  # (parent_id, entity) of the non-root entities of a JSON Lines stash
+        if is_jsonl_stash(source_path):
+            number_of_source_entities = count_stash_entities(source_path)  # Raises if the stash is incomplete
+            source_entity_types, source_root_entities, source_entities = read_stash(source_path)
+            database_dict = {"entity_types": source_entity_types, "entities": source_root_entities}
+        else:
+            with open(source_path, "r") as f:
+                database_dict = json.load(f)  # Get the database file
         entity_types = self.get_entity_types()
         destination_root_entities = self.get_root_entities()
         validate_root_entities_compatibility(database_dict["entities"], destination_root_entities)
 
-        print("Successfully validated database compatibility. Removing children...")
-        for root_entity in destination_root_entities:
-            self.delete_children(root_entity["id"])
-        # Make an entity type mapping from source entity type -> destination entity type
-        entity_type_mapping = get_entity_type_mapping_from_entity_types(
-            source_entity_types=database_dict["entity_types"], destination_entity_types=entity_types
-        )
+        old_to_new_ids_mapping, marks = {}, set()  # marks: the steps that were finished before an interruption
+        if checkpointed:
+            journal_path = source_path.with_name(f"{source_path.name}.progress.jsonl")
+            old_to_new_ids_mapping = self._open_upload_journal(journal_path)
+            marks = old_to_new_ids_mapping.marks
+            if "children_removed" in marks:
+                print(f"Resuming upload, {len(old_to_new_ids_mapping)} entities were uploaded already")
+        try:
+            if "children_removed" not in marks:
+                print("Successfully validated database compatibility. Removing children...")
+                for root_entity in destination_root_entities:
+                    self.delete_children(root_entity["id"])
+                if checkpointed:
+                    old_to_new_ids_mapping.mark("children_removed")
+            # Make an entity type mapping from source entity type -> destination entity type
+            entity_type_mapping = get_entity_type_mapping_from_entity_types(
+                source_entity_types=database_dict["entity_types"], destination_entity_types=entity_types
+            )
 
-        print("Uploading database...")
-        old_to_new_ids_mapping = {}
-        for source_root_entity, destination_root_entity in zip(database_dict["entities"], destination_root_entities):
-            # Let's first set the revisions
-            self.update_entity(destination_root_entity["id"], source_root_entity["properties"],
-                               message="Apply database stash")
-            old_to_new_ids_mapping.update({source_root_entity["id"]: destination_root_entity["id"]})  # Update the entity map
-            # Then let's upload the children
-            self.post_entity_tree(source_root_entity, entity_type_mapping=entity_type_mapping,
-                                  parent_id=destination_root_entity["id"], old_to_new_ids_mapping=old_to_new_ids_mapping)
-
-        print("Replacing entity IDs...")
-        parametrization_dict = {}  # Make a dict to store entity_type and its field names that refer to entity types
-        for entity_id in old_to_new_ids_mapping.values():  # For every entity that is uploaded to the database
-            entity = self.get_entity(entity_id)  # Get the entity
-            if entity["entity_type"] not in parametrization_dict:  # Parametrization is not yet analysed for this type
-                parametrization = self.get_parametrization(entity_id)
-                field_names_list_container = []  # Set up the ID fields list
-                if parametrization:
-                    add_field_names_referring_to_entities_to_container(parametrization["parametrization"],
-                                                                       field_names_list_container)
-                parametrization_dict.update({entity["entity_type"]: field_names_list_container})
-            if field_names_list_container := parametrization_dict[entity["entity_type"]]:
-                properties = entity["properties"]
-                for field_names_list in field_names_list_container:
-                    update_id_on_entity_fields(field_names_list=field_names_list, properties=properties,
-                                               old_to_new_ids_mapping=old_to_new_ids_mapping)
-                self.update_entity(entity_id, properties)
+            print("Uploading database...")
+            for source_root_entity, destination_root_entity in zip(database_dict["entities"],
+                                                                   destination_root_entities):
+                # Let's first set the revisions, unless that was done before the upload was interrupted
+                if source_root_entity["id"] not in old_to_new_ids_mapping:
+                    self.update_entity(destination_root_entity["id"], source_root_entity["properties"],
+                                       message="Apply database stash")
+                    # Update the entity map
+                    old_to_new_ids_mapping.update({source_root_entity["id"]: destination_root_entity["id"]})
+                # Then let's upload the children
+                if source_entities is None:
+                    self.post_entity_tree(source_root_entity, entity_type_mapping=entity_type_mapping,
+                                          parent_id=destination_root_entity["id"],
+                                          old_to_new_ids_mapping=old_to_new_ids_mapping)
+            if source_entities is not None:  # The children of all root entities are in one stream
+                with click.progressbar(length=number_of_source_entities,
+                                       label=f'Posting entities to {self.name}') as progressbar:
+                    self._progressbar = progressbar
+                    self.post_entity_stream(source_entities, entity_type_mapping, old_to_new_ids_mapping)
+
+            print("Replacing entity IDs...")
+            parametrization_dict = {}  # Make a dict to store entity_type and its field names that refer to entity types
+            for entity_id in list(old_to_new_ids_mapping.values()):  # For every entity that is uploaded to the database
+                if f"ids_replaced:{entity_id}" in marks:  # Done before the upload was interrupted
+                    continue
+                entity = self.get_entity(entity_id)  # Get the entity
+                # Parametrization is not yet analysed for this type
+                if entity["entity_type"] not in parametrization_dict:
+                    parametrization = self.get_parametrization(entity_id)
+                    field_names_list_container = []  # Set up the ID fields list
+                    if parametrization:
+                        add_field_names_referring_to_entities_to_container(parametrization["parametrization"],
+                                                                           field_names_list_container)
+                    parametrization_dict.update({entity["entity_type"]: field_names_list_container})
+                if field_names_list_container := parametrization_dict[entity["entity_type"]]:
+                    properties = entity["properties"]
+                    for field_names_list in field_names_list_container:
+                        update_id_on_entity_fields(field_names_list=field_names_list, properties=properties,
+                                                   old_to_new_ids_mapping=old_to_new_ids_mapping)
+                    self.update_entity(entity_id, properties)
+                if checkpointed:
+                    old_to_new_ids_mapping.mark(f"ids_replaced:{entity_id}")
+            if checkpointed:  # A new upload of the same stash starts over
+                old_to_new_ids_mapping.mark("finished")
+                old_to_new_ids_mapping.remove()
+        finally:
+            if checkpointed:
+                old_to_new_ids_mapping.close()
         print("Successfully applied stashed database!")
 
+    def _open_upload_journal(self, path: Path) -> IdMappingJournal:
+        """Journal of a checkpointed upload to this sub-domain, which refuses to resume an upload to another one"""
+        destination = f"{self.host}{self.workspace}"
+        journal = IdMappingJournal(path)
+        if "finished" in journal.marks:  # The journal of an upload that was finished, but could not be removed
+            journal.remove()
+            journal = IdMappingJournal(path)
+        journal_destinations = {mark.split(":", 1)[1] for mark in journal.marks if mark.startswith("destination:")}
+        if not journal_destinations:
+            journal.mark(f"destination:{destination}")
+        elif journal_destinations != {destination}:
+            journal.close()
+            raise click.ClickException(
+                f"{path} belongs to an interrupted upload to {', '.join(journal_destinations)}. Finish that upload, "
+                f"or remove the file to upload to {destination}"
+            )
+        return journal
+
     def add_user(self, user: UserDict):
         user_data = {
             'email': user['email'],
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+from height_map_utils import as_masked_array
+from viktor_subdomain import http_transport
+from viktor_subdomain.helper_functions import set_environment_variables
+
+set_environment_variables()
+FORMA_PROJECT_ID = os.getenv("FORMA_PROJECT_ID", "pro_nz1xbbzv0p")
+FORMA_TOKEN = os.getenv("FORMA_TOKEN", "bkhFR0hMeDk4OTJUaXFsTFZaQmJjbEdjYUVwMUcya2Q6aXJMTDZrOXJ4elRGaTlnWA==")
+# e.g. http://127.0.0.1:8765 to run against wind_stub_server.py
+FORMA_WIND_BASE_URL = os.getenv("FORMA_WIND_BASE_URL", "https://app.autodeskforma.eu")
+WIND_REQUESTS_PER_SECOND = float(os.getenv("WIND_REQUESTS_PER_SECOND", 4))
+WIND_RESULT_CACHE_SIZE = 64
+
+
+class RateLimiter:
+    """Spaces calls to wait() at least 1 / rate seconds apart, over all threads"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+_rate_limiter = RateLimiter(WIND_REQUESTS_PER_SECOND)
+# results by payload hash, requests that are still running are shared by everyone asking for the same payload
+_results = OrderedDict()
+_results_lock = threading.Lock()
+_stats = {"requests": 0, "coalesced": 0, "seconds": 0.0}
+
+
+def normalize_height_maps(terrain_height_map, terrain_and_buildings_height_map) -> dict:
+    """heightMaps part of the request, both maps scaled to 0-1 over their common elevation range and rounded.
+
+    Pixels without geometry are sent as the lowest height.
+    """
+    terrain = as_masked_array(terrain_height_map)
+    terrain_and_buildings = as_masked_array(terrain_and_buildings_height_map)
+    min_height = min(terrain_and_buildings.min(), terrain.min())
+    max_height = max(terrain_and_buildings.max(), terrain.max())
+    height_range = float(max_height) - float(min_height)
+
+    def normalize(height_map):
+        heights = height_map.filled(min_height).astype(np.float64).ravel()
+        if not height_range:
+            return np.zeros(heights.shape, dtype=np.uint8)
+        return np.rint((heights - float(min_height)) / height_range).astype(np.uint8)
+
+    return {
+        "terrainHeightArray": normalize(terrain).tolist(),
+        "buildingAndTerrainHeightArray": normalize(terrain_and_buildings).tolist(),
+        "minHeight": int(min_height),
+        "maxHeight": int(max_height),
+    }
+
+
+def _payload(terrain_height_map, terrain_and_buildings_height_map, wind_rose) -> bytes:
+    """Request body as compact json"""
+    body = {
+        "heightMaps": normalize_height_maps(terrain_height_map, terrain_and_buildings_height_map),
+        "windRose": wind_rose,
+        "type": "comfort",
+        "roughness": 0.4978,
+        "comfortScale": "lawson_lddc",
+    }
+    return json.dumps(body, separators=(",", ":")).encode()
+
+
+def _post_analysis(payload: bytes, shape):
+    _rate_limiter.wait()
+    start = time.perf_counter()
+    res = http_transport.post(
+        f"{FORMA_WIND_BASE_URL}/api/surrogate/forma-wind-core/experimental",
+        params={"authcontext": FORMA_PROJECT_ID, "direction": 0, "analysisType": "comfort",
+                "comfortScale": "lawson_lddc"},
+        headers={"Authorization": "Bearer " + FORMA_TOKEN, "Content-Type": "application/json"},
+        data=payload,
+    )
+    with _results_lock:
+        _stats["requests"] += 1
+        _stats["seconds"] += time.perf_counter() - start
+    res.raise_for_status()
+
+    data = res.json()
+    arr = np.array(data["heatmap_data"])
+    mask = np.array(data["heatmap_mask"], dtype=bool)
+    if arr.shape != tuple(shape) and arr.size == np.prod(shape):
+        arr, mask = arr.reshape(shape), mask.reshape(shape)
+    return np.ma.masked_array(arr, mask=mask)
+
+
+def analyze_wind_comfort(terrain_height_map, terrain_and_buildings_height_map, wind_rose):
+    """Wind comfort of the height maps from the Forma wind surrogate.
+
+    Identical requests are sent once: a request for a payload that is already running waits for that request, and
+    recent results are reused. Requests are rate limited to WIND_REQUESTS_PER_SECOND over all threads.
+    """
+    payload = _payload(terrain_height_map, terrain_and_buildings_height_map, wind_rose)
+    key = hashlib.sha256(payload).hexdigest()
+    with _results_lock:
+        future = _results.get(key)
+        owner = future is None
+        if owner:
+            future = _results[key] = Future()
+            while len(_results) > WIND_RESULT_CACHE_SIZE:
+                _results.popitem(last=False)
+        else:
+            _results.move_to_end(key)
+            _stats["coalesced"] += 1
+
+    if owner:
+        try:
+            future.set_result(_post_analysis(payload, terrain_height_map["map"].shape))
+        except Exception as e:
+            future.set_exception(e)
+            with _results_lock:  # do not keep failures, the next request tries again
+                if _results.get(key) is future:
+                    del _results[key]
+    return future.result().copy()
+
+
+def analyze_wind_comfort_batch(height_map_pairs, wind_rose, max_in_flight=4) -> list:
+    """analyze_wind_comfort of a list of (terrain, terrain and buildings) height maps, in the same order.
+
+    At most max_in_flight requests run at the same time, pairs with identical height maps are only sent once.
+    """
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        futures = [pool.submit(analyze_wind_comfort, terrain, terrain_and_buildings, wind_rose)
+                   for terrain, terrain_and_buildings in height_map_pairs]
+        return [future.result() for future in futures]
+
+
+def get_stats() -> dict:
+    """Number of requests sent, requests answered by a running or earlier identical request, and mean latency"""
+    with _results_lock:
+        requests = _stats["requests"]
+        return {"requests": requests, "coalesced": _stats["coalesced"],
+                "mean_seconds": _stats["seconds"] / requests if requests else 0.0}
+
+
+def clear_results() -> None:
+    with _results_lock:
+        _results.clear()
@@ -0,0 +1,83 @@
+"""Local stand-in for the Forma wind surrogate, to develop and load test the wind analysis offline.
+
+Run with `python wind_stub_server.py --port 8765 --latency 0.5` and set FORMA_WIND_BASE_URL=http://127.0.0.1:8765
+"""
+import argparse
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+def _heatmap(height_maps):
+    """Fake comfort: the normalized height of the buildings above the terrain"""
+    terrain = np.asarray(height_maps["terrainHeightArray"], dtype=float)
+    terrain_and_buildings = np.asarray(height_maps["buildingAndTerrainHeightArray"], dtype=float)
+    heatmap = terrain_and_buildings - terrain
+    side = math.isqrt(heatmap.size)
+    if side * side == heatmap.size:
+        heatmap = heatmap.reshape(side, side)
+    return heatmap
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        try:
+            time.sleep(self.server.latency)
+            heatmap = _heatmap(json.loads(body)["heightMaps"])
+            response = json.dumps({
+                "heatmap_data": heatmap.tolist(),
+                "heatmap_mask": np.zeros(heatmap.shape, dtype=bool).tolist(),
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(port=0, latency=0.0) -> ThreadingHTTPServer:
+    """Starts the stub in a background thread, port 0 picks a free port. Stop it with server.shutdown()
+
+    The server counts the requests it received and the most requests it handled at the same time, in requests and
+    max_in_flight.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.in_flight = 0
+    server.max_in_flight = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    args = parser.parse_args()
+
+    stub = start_stub_server(args.port, args.latency)
+    print(f"Wind stub server on http://127.0.0.1:{stub.server_address[1]}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stub.shutdown()